@@ -1,17 +1,41 @@
 import streamlit as st
 from streamlit_image_coordinates import streamlit_image_coordinates
 import pandas as pd
-from PIL import Image, ImageDraw
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+import qrcode
 from supabase import create_client, Client
 import json
+import html
 import folium
-from folium.plugins import Draw
+from folium.plugins import Draw, MarkerCluster
 from streamlit_folium import st_folium
 from folium.raster_layers import ImageOverlay
+from folium.elements import JSCSSMixin
+from branca.element import MacroElement
+from jinja2 import Template
 import io
 import altair as alt
 from datetime import datetime
 from streamlit_option_menu import option_menu
+import sqlite3
+import threading
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, as_completed
+import time
+import uuid
+import os
+import math
+import re
+import unicodedata
+from bisect import bisect_left
+from functools import reduce, partial
+import importlib.util
+import hashlib
+import shutil
+import zipfile
+import warnings
+from collections import OrderedDict, deque
 
 # --- 1. CONFIGURACIÓN DE PÁGINA ---
 st.set_page_config(
@@ -50,55 +74,500 @@ def init_connection():
 
 supabase = init_connection()
 
+# Columnas esperadas en la App (Mayúsculas/CamelCase)
+COLUMNAS_APP = [
+    'id', 'x1', 'y1', 'x2', 'y2', 'Zona', 'TipoFuga', 'Area', 'Ubicacion',
+    'ID_Maquina', 'Severidad', 'Categoria', 'L_min', 'CostoAnual', 'Estado', 'Comentarios'
+]
+
+# Mapa de minúsculas -> Nombre en App
+RENAME_MAP = {
+    'zona': 'Zona',
+    'tipofuga': 'TipoFuga', 'tipo_fuga': 'TipoFuga', # Soporte para ambos casos
+    'area': 'Area',
+    'ubicacion': 'Ubicacion',
+    'id_maquina': 'ID_Maquina', 'idmaquina': 'ID_Maquina',
+    'severidad': 'Severidad',
+    'categoria': 'Categoria',
+    'l_min': 'L_min', 'lmin': 'L_min',
+    'costo_anual': 'CostoAnual', 'costoanual': 'CostoAnual',
+    'estado': 'Estado',
+    'comentarios': 'Comentarios', 'comentario': 'Comentarios',
+    'x1': 'x1', 'y1': 'y1', 'x2': 'x2', 'y2': 'y2'
+}
+
+# --- ESQUEMA TIPADO ---
+# Los tipos se fijan una sola vez al cargar; ningún consumidor vuelve a convertir.
+# Coordenadas en float32 (lienzo de 1200 px), montos en float64, texto libre como
+# string nullable y las fechas de 'Zona' ("dd/mm/aaaa - dd/mm/aaaa") ya interpretadas.
+COLUMNAS_CATEGORICAS = ['TipoFuga', 'Estado', 'Area', 'Severidad', 'Categoria', 'Ubicacion']
+COLUMNAS_FECHA = ['FechaInicio', 'FechaTermino']
+ESQUEMA_FUGAS = {
+    'id': 'Int64',
+    'x1': 'float32', 'y1': 'float32', 'x2': 'float32', 'y2': 'float32',
+    'L_min': 'float64', 'CostoAnual': 'float64',
+    'Zona': 'string', 'ID_Maquina': 'string', 'Comentarios': 'string',
+    **{c: 'category' for c in COLUMNAS_CATEGORICAS}
+}
+PATRON_FECHAS_ZONA = r'(\d{1,2}/\d{1,2}/\d{4})\s*-\s*(\d{1,2}/\d{1,2}/\d{4})'
+
+def a_numero(serie):
+    # Números tal cual; rangos "a-b" (registros viejos de L_min) -> punto medio, como al guardar
+    if pd.api.types.is_numeric_dtype(serie):
+        return serie.astype('float64')
+    texto = serie.astype('string').str.replace('I/min', '', regex=False).str.strip()
+    # astype: con entrada vacía o toda nula, extract/to_numeric dejan las columnas como string
+    rango = texto.str.extract(r'^(\d*\.?\d+)\s*-\s*(\d*\.?\d+)$').apply(pd.to_numeric, errors='coerce').astype('float64')
+    numeros = pd.to_numeric(texto, errors='coerce').astype('float64')
+    return numeros.fillna(((rango[0] + rango[1]) / 2).astype('float64'))
+
+def tipar_fugas(df):
+    df = df.copy()
+    for col, tipo in ESQUEMA_FUGAS.items():
+        if col not in df.columns:
+            # Faltantes: numéricas vacías, texto con el "N/A" de siempre
+            df[col] = pd.Series(np.nan if tipo.startswith(('float', 'Int')) else "N/A", index=df.index)
+        if tipo.startswith('float'):
+            df[col] = a_numero(df[col]).astype(tipo)
+        elif tipo == 'Int64':
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype('Int64')
+        else:
+            df[col] = df[col].astype(tipo)
+    fechas = df['Zona'].str.extract(PATRON_FECHAS_ZONA)
+    for col, texto in zip(COLUMNAS_FECHA, (fechas[0], fechas[1])):
+        df[col] = pd.to_datetime(texto, format='%d/%m/%Y', errors='coerce')
+    return df
+
+def con_categorias(df):
+    # Tras concatenar frames, las categóricas con categorías distintas quedan como object
+    if df is None:
+        return df
+    tipos = {c: 'category' for c in COLUMNAS_CATEGORICAS if c in df.columns and not isinstance(df[c].dtype, pd.CategoricalDtype)}
+    return df.astype(tipos) if tipos else df
+
+def normalizar_fugas(data):
+    # Convierte filas crudas de Supabase al esquema de la App (mismo para carga completa y delta)
+    if not data:
+        return tipar_fugas(pd.DataFrame(columns=COLUMNAS_APP))
+
+    df = pd.DataFrame(data)
+
+    # Normalizar columnas de entrada a minúsculas
+    df.columns = [c.lower() for c in df.columns]
+    df = df.rename(columns=RENAME_MAP)
+    return tipar_fugas(df)
+
+# --- CARGA MASIVA PAGINADA ---
+# PostgREST corta un select("*") en su max-rows, así que leemos por páginas con
+# paginación keyset (id > último id visto). El rango de ids se reparte en tramos
+# que se leen en paralelo; cada página se normaliza al llegar y al final se concatenan.
+TAM_PAGINA = 1000   # Igual al max-rows por defecto de PostgREST
+HILOS_CARGA = 4
+
+def pagina_supabase(despues_de, hasta, limite, desde_updated=None):
+    consulta = supabase.table("fugas").select("*").order("id").limit(limite)
+    if despues_de is not None:
+        consulta = consulta.gt("id", despues_de)
+    if hasta is not None:
+        consulta = consulta.lte("id", hasta)
+    if desde_updated is not None:
+        consulta = consulta.gte("updated_at", desde_updated)
+    return consulta.execute().data or []
+
+def filas_paginadas(obtener_pagina, despues_de=None, tam_pagina=TAM_PAGINA):
+    # Todas las filas crudas, por keyset de id (una página corta no significa fin)
+    filas = []
+    while True:
+        pagina = obtener_pagina(despues_de, None, tam_pagina)
+        if not pagina:
+            return filas
+        filas += pagina
+        despues_de = pagina[-1]['id']
+
+def rango_ids_supabase():
+    # (id mínimo, id máximo, total de filas) o None si la tabla está vacía
+    primero = supabase.table("fugas").select("id", count="exact").order("id").limit(1).execute()
+    if not primero.data:
+        return None
+    ultimo = supabase.table("fugas").select("id").order("id", desc=True).limit(1).execute()
+    return primero.data[0]['id'], ultimo.data[0]['id'], primero.count or 0
+
+def fuente_sqlite(ruta, tabla="fugas"):
+    # Sustituto local de PostgREST (mismo contrato que pagina_supabase/rango_ids_supabase)
+    # para probar la carga con tablas grandes sin conexión.
+    def consultar(sql, params=()):
+        with closing(sqlite3.connect(ruta)) as con:
+            con.row_factory = sqlite3.Row
+            return [dict(r) for r in con.execute(sql, params)]
+
+    def obtener_pagina(despues_de, hasta, limite):
+        condiciones, params = [], []
+        if despues_de is not None:
+            condiciones.append("id > ?")
+            params.append(despues_de)
+        if hasta is not None:
+            condiciones.append("id <= ?")
+            params.append(hasta)
+        where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+        return consultar(f"SELECT * FROM {tabla} {where} ORDER BY id LIMIT ?", params + [limite])
+
+    def rango_ids():
+        r = consultar(f"SELECT MIN(id) AS mn, MAX(id) AS mx, COUNT(*) AS n FROM {tabla}")[0]
+        return None if r['n'] == 0 else (r['mn'], r['mx'], r['n'])
+
+    return obtener_pagina, rango_ids
+
+def leer_tramo(obtener_pagina, desde, hasta, tam_pagina, al_leer=None):
+    # Keyset dentro del tramo (desde, hasta]. Una página corta NO significa fin:
+    # el servidor puede tener un max-rows menor que tam_pagina, así que seguimos hasta vaciar.
+    paginas = []
+    cursor = desde
+    while True:
+        filas = obtener_pagina(cursor, hasta, tam_pagina)
+        if not filas:
+            break
+        paginas.append(normalizar_fugas(filas))
+        if al_leer:
+            al_leer(len(filas))
+        cursor = filas[-1]['id']
+        if hasta is not None and cursor >= hasta:
+            break
+    return paginas
+
+def cargar_fugas_paginado(obtener_pagina, rango_ids, tam_pagina=TAM_PAGINA, hilos=HILOS_CARGA, al_progresar=None):
+    rango = rango_ids()
+    if rango is None:
+        return normalizar_fugas([])
+    id_min, id_max, total = rango
+
+    # Repartimos (id_min - 1, id_max] en tramos contiguos, uno por hilo
+    hilos = max(1, min(hilos, total // tam_pagina + 1))
+    paso = (id_max - id_min + 1) / hilos
+    cortes = [id_min - 1] + [int(id_min - 1 + paso * (i + 1)) for i in range(hilos - 1)] + [id_max]
+    tramos = list(zip(cortes[:-1], cortes[1:]))
+
+    leidas = [0]
+    candado = threading.Lock()
+    def al_leer(n):
+        with candado:
+            leidas[0] += n
+
+    resultados = {}
+    with ThreadPoolExecutor(max_workers=hilos) as pool:
+        pendientes = {pool.submit(leer_tramo, obtener_pagina, a, b, tam_pagina, al_leer): i for i, (a, b) in enumerate(tramos)}
+        # El progreso se reporta desde el hilo principal (Streamlit no admite llamadas desde los workers)
+        while pendientes:
+            hechos, _ = wait(pendientes, timeout=0.2, return_when=FIRST_COMPLETED)
+            for fut in hechos:
+                resultados[pendientes.pop(fut)] = fut.result()
+            if al_progresar:
+                al_progresar(leidas[0], total)
+
+    paginas = [p for i in sorted(resultados) for p in resultados[i]]
+    if not paginas:
+        return normalizar_fugas([])
+    return pd.concat(paginas, ignore_index=True)
+
 def cargar_datos():
     if supabase:
         try:
+            barra = st.progress(0.0, text="Cargando fugas...")
+            def al_progresar(leidas, total):
+                avance = min(leidas / total, 1.0) if total else 1.0
+                barra.progress(avance, text=f"Cargando fugas... {leidas:,} / {total:,}")
+
             # Usar esquema public por defecto
-            response = supabase.table("fugas").select("*").execute()
-            data = response.data
-            
-            # Columnas esperadas en la App (Mayúsculas/CamelCase)
-            columnas_app = [
-                'id', 'x1', 'y1', 'x2', 'y2', 'Zona', 'TipoFuga', 'Area', 'Ubicacion',
-                'ID_Maquina', 'Severidad', 'Categoria', 'L_min', 'CostoAnual', 'Estado', 'Comentarios'
-            ]
-            
-            if data:
-                df = pd.DataFrame(data)
-                
-                # Normalizar columnas de entrada a minúsculas
-                df.columns = [c.lower() for c in df.columns]
-                
-                # Mapa de minúsculas -> Nombre en App
-                rename_map = {
-                    'zona': 'Zona', 
-                    'tipofuga': 'TipoFuga', 'tipo_fuga': 'TipoFuga', # Soporte para ambos casos
-                    'area': 'Area', 
-                    'ubicacion': 'Ubicacion', 
-                    'id_maquina': 'ID_Maquina', 'idmaquina': 'ID_Maquina',
-                    'severidad': 'Severidad', 
-                    'categoria': 'Categoria', 
-                    'l_min': 'L_min', 'lmin': 'L_min',
-                    'costo_anual': 'CostoAnual', 'costoanual': 'CostoAnual',
-                    'estado': 'Estado',
-                    'comentarios': 'Comentarios', 'comentario': 'Comentarios',
-                    'x1': 'x1', 'y1': 'y1', 'x2': 'x2', 'y2': 'y2'
-                }
-                
-                df = df.rename(columns=rename_map)
-                
-                # Asegurar que existan todas las columnas esperadas
-                for col in columnas_app:
-                    if col not in df.columns:
-                        df[col] = "N/A"
-                return df
-                
-            return pd.DataFrame(columns=columnas_app)
+            df = cargar_fugas_paginado(pagina_supabase, rango_ids_supabase, al_progresar=al_progresar)
+            barra.empty()
+            return df
         except Exception as e:
             st.error(f"Error cargando datos: {e}")
-            return pd.DataFrame()
-            
-    return pd.DataFrame()
+            return None
+
+    return normalizar_fugas([])
+
+# --- SINCRONIZACIÓN INCREMENTAL (DELTA) ---
+# En lugar de recargar toda la tabla tras cada clic, guardamos una "marca de agua"
+# (último updated_at / id visto) y solo pedimos las filas que cambiaron desde entonces.
+# Los borrados llegan como lápidas (tabla 'fugas_borradas', ver supabase/migrations).
+# Si cambia VERSION_SYNC (esquema local) se fuerza una resincronización completa.
+VERSION_SYNC = 1
+
+def calcular_marca(df, marca_anterior=None):
+    marca = {
+        'version': VERSION_SYNC,
+        'updated_at': None,
+        'id': None,
+        'borrado_at': (marca_anterior or {}).get('borrado_at'),
+    }
+    if df is None or df.empty:
+        return marca
+
+    if 'updated_at' in df.columns:
+        # ISO8601: Postgres omite las fracciones de segundo cuando valen cero, así que
+        # en un mismo lote conviven "…10:00:00+00:00" y "…10:00:00.123+00:00"
+        fechas = pd.to_datetime(df['updated_at'], errors='coerce', utc=True, format='ISO8601')
+        if fechas.notna().any():
+            marca['updated_at'] = fechas.max().isoformat()
+            # Tras una carga completa, las lápidas anteriores a los datos ya no importan
+            if marca['borrado_at'] is None:
+                marca['borrado_at'] = marca['updated_at']
+
+    if df['id'].notna().any():
+        marca['id'] = int(df['id'].max())
+    return marca
+
+def obtener_delta(marca, ids_cambiados=None):
+    # Filas nuevas o modificadas desde la marca de agua, paginadas como la carga completa
+    # para que un delta grande no quede cortado en el max-rows de PostgREST
+    if marca.get('updated_at'):
+        # gte: las filas repetidas se fusionan por id, así no perdemos commits concurrentes
+        filas = filas_paginadas(partial(pagina_supabase, desde_updated=marca['updated_at']))
+    else:
+        # Sin columna updated_at solo podemos detectar inserciones nuevas
+        filas = filas_paginadas(pagina_supabase, marca.get('id'))
+
+    # Filas editadas en esta sesión: se piden por id por si la tabla aún no tiene updated_at
+    if ids_cambiados:
+        filas += supabase.table("fugas").select("*").in_("id", list(ids_cambiados)).execute().data or []
+
+    # Lápidas de registros borrados (si la tabla no existe, seguimos solo con inserciones/cambios)
+    ids_borrados = set()
+    borrado_at = marca.get('borrado_at')
+    try:
+        consulta_b = supabase.table("fugas_borradas").select("id, deleted_at")
+        if borrado_at:
+            consulta_b = consulta_b.gte("deleted_at", borrado_at)
+        lapidas = consulta_b.execute().data or []
+        for l in lapidas:
+            ids_borrados.add(l['id'])
+            if l.get('deleted_at') and (borrado_at is None or l['deleted_at'] > borrado_at):
+                borrado_at = l['deleted_at']
+    except Exception:
+        pass
+
+    return filas, ids_borrados, borrado_at
+
+def descartar_conocidas(df, filas):
+    # gte devuelve siempre la fila cuyo updated_at es la marca; si el frame local ya la
+    # tiene con ese mismo updated_at no es un cambio (si no, cada TTL publicaría versión)
+    if not filas or df is None or df.empty or 'updated_at' not in df.columns:
+        return filas
+    nuevas = pd.DataFrame(filas)
+    if 'updated_at' not in nuevas.columns:
+        return filas
+    locales = df.loc[df['id'].isin(nuevas['id']), ['id', 'updated_at']].drop_duplicates('id')
+    fechas = pd.Series(pd.to_datetime(locales['updated_at'], errors='coerce', utc=True, format='ISO8601').to_numpy(),
+                       index=locales['id'].astype('int64').to_numpy())
+    repetidas = nuevas['id'].map(fechas).eq(pd.to_datetime(nuevas['updated_at'], errors='coerce', utc=True, format='ISO8601'))
+    return [f for f, repetida in zip(filas, repetidas) if not repetida]
+
+def fusionar_delta(df, filas, ids_borrados):
+    df_nuevos = normalizar_fugas(filas)
+
+    # Si el servidor trae columnas que no conocemos, el esquema cambió -> resincronizar
+    columnas_extra = set(df_nuevos.columns) - set(df.columns)
+    if not df_nuevos.empty and columnas_extra:
+        return None
+
+    ids_fuera = set(ids_borrados) | set(df_nuevos['id'])
+    if ids_fuera:
+        df = df[~df['id'].isin(ids_fuera)]
+    if not df_nuevos.empty:
+        df_nuevos = df_nuevos[~df_nuevos['id'].isin(set(ids_borrados))]
+        df_nuevos = df_nuevos.drop_duplicates('id', keep='last').reindex(columns=df.columns)
+        df = pd.concat([df, df_nuevos], ignore_index=True)
+
+    return df.sort_values('id', kind='stable').reset_index(drop=True)
+
+# --- CACHÉ COMPARTIDA DEL DATASET (TODAS LAS SESIONES) ---
+# Un solo DataFrame de fugas por proceso, con contador de versión y TTL. Las sesiones
+# solo leen la referencia publicada (no la modifican); cada cambio publica un frame
+# nuevo con versión + 1. "Recargar Datos" invalida solo este dataset, sin tocar la
+# conexión de init_connection() que comparten todos los usuarios.
+TTL_DATOS = 60  # segundos antes de pedir un delta al servidor aunque nadie haya escrito
+
+class AlmacenFugas:
+    def __init__(self, ttl):
+        self.candado = threading.RLock()
+        self.ttl = ttl
+        self.df = None
+        self.version = 0
+        self.marca = None
+        self.sincronizado_en = 0.0
+        self.conciliaciones = []
+        self.avisos = []
+        self.derivados = {}
+
+    def leer(self):
+        with self.candado:
+            return self.version, self.df
+
+    def vencido(self):
+        return self.df is None or (time.monotonic() - self.sincronizado_en) > self.ttl
+
+    def publicar(self, df, marca=None):
+        df = con_categorias(df)
+        with self.candado:
+            self.df = df
+            self.version += 1
+            if marca is not None:
+                self.marca = marca
+            self.sincronizado_en = time.monotonic()
+
+    def invalidar(self):
+        with self.candado:
+            self.df = None
+            self.marca = None
+            self.conciliaciones = []
+            self.derivados = {}
+
+    def derivado(self, nombre, version, df, fn, *clave):
+        # Memoiza estructuras calculadas a partir de una versión del dataset (geometría,
+        # índices...). Al llegar una versión nueva se descartan las de versiones viejas.
+        llave = (nombre, version) + clave
+        with self.candado:
+            if llave in self.derivados:
+                return self.derivados[llave]
+        resultado = fn(df)
+        with self.candado:
+            vigentes = {version, self.version}
+            self.derivados = {k: v for k, v in self.derivados.items() if k[1] in vigentes}
+            self.derivados[llave] = resultado
+        return resultado
+
+@st.cache_resource
+def almacen_fugas():
+    return AlmacenFugas(TTL_DATOS)
+
+def sincronizar_datos(almacen, forzar=False, ids_borrados=None, ids_cambiados=None, si_vencido=False, reiniciar=False):
+    # Bajo el candado: si 40 sesiones llegan a la vez, solo la primera va a la red
+    with almacen.candado:
+        # Las demás esperaron el candado mientras la primera refrescaba: ya no hay nada que pedir
+        if si_vencido and not almacen.vencido():
+            return
+        marca = almacen.marca
+        df_actual = almacen.df
+
+        # Resincronización completa: a petición, primera carga o versión distinta
+        if forzar or marca is None or marca.get('version') != VERSION_SYNC or df_actual is None or df_actual.empty or not supabase:
+            df = cargar_datos()
+            if df is None:
+                # Falló la carga: se conservan el frame y la versión vigentes hasta el próximo TTL
+                if df_actual is not None:
+                    almacen.sincronizado_en = time.monotonic()
+                    return
+                df = normalizar_fugas([])
+            # "Recargar Datos": el reinicio va en la misma sección crítica que la carga,
+            # así ninguna sesión lee el almacén vacío entre ambos pasos
+            if reiniciar:
+                almacen.invalidar()
+            almacen.publicar(df, calcular_marca(df))
+            return
+
+        try:
+            filas, borrados_servidor, borrado_at = obtener_delta(marca, ids_cambiados)
+        except Exception as e:
+            st.warning(f"Sincronización incremental falló, recargando todo: {e}")
+            return sincronizar_datos(almacen, forzar=True)
+        filas = descartar_conocidas(df_actual, filas)
+
+        # Los borrados hechos en esta sesión se aplican aunque no exista la tabla de lápidas
+        todos_borrados = borrados_servidor | set(ids_borrados or [])
+        if not filas and not (todos_borrados & set(df_actual['id'])):
+            # Nada nuevo: no publicamos versión para no invalidar cachés derivadas
+            # La marca publicada es de solo lectura (otras sesiones pueden tenerla): se reemplaza
+            almacen.sincronizado_en = time.monotonic()
+            almacen.marca = {**marca, 'borrado_at': borrado_at}
+            return
+
+        df = fusionar_delta(df_actual, filas, todos_borrados)
+        if df is None:
+            return sincronizar_datos(almacen, forzar=True)
+
+        marca_nueva = calcular_marca(df, marca)
+        marca_nueva['borrado_at'] = borrado_at
+        almacen.publicar(df, marca_nueva)
+
+# --- MUTACIÓN OPTIMISTA DEL DATASET ---
+# Tras una escritura exitosa aplicamos la fila que devuelve Supabase (insert/update
+# devuelven la representación completa) o quitamos el id borrado directamente en el
+# dataset compartido, sin volver a pedir la tabla. En segundo plano se pide el delta
+# al servidor; en la siguiente ejecución se fusiona y, si el servidor no coincide con
+# lo aplicado (borrado bloqueado, edición concurrente...), gana la versión del servidor.
+@st.cache_resource
+def pool_conciliacion():
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="conciliacion")
+
+def id_sesion():
+    if 'id_sesion' not in st.session_state:
+        st.session_state.id_sesion = uuid.uuid4().hex
+    return st.session_state.id_sesion
+
+def mutar_dataset(almacen, tipo, id_registro, filas=None):
+    with almacen.candado:
+        df = almacen.df
+        if tipo == 'borrado':
+            df_nuevo = fusionar_delta(df, [], {id_registro})
+        else:
+            df_nuevo = fusionar_delta(df, filas, set())
+        if df_nuevo is None:
+            # La fila trae columnas desconocidas: el esquema cambió
+            sincronizar_datos(almacen, forzar=True)
+            return
+        # La marca no avanza: la fija la conciliación, que sí ve los cambios de otros
+        almacen.publicar(df_nuevo)
+
+        marca = dict(almacen.marca or calcular_marca(df))
+        futuro = pool_conciliacion().submit(obtener_delta, marca, [id_registro])
+        almacen.conciliaciones.append({
+            'futuro': futuro,
+            'id': id_registro,
+            'tipo': tipo,
+            'aplicado': filas[-1] if filas else None,
+            'sesion': id_sesion(),
+        })
+
+def procesar_conciliaciones(almacen):
+    with almacen.candado:
+        restantes = []
+        for p in almacen.conciliaciones:
+            if not p['futuro'].done():
+                restantes.append(p)
+                continue
+            try:
+                filas, borrados, borrado_at = p['futuro'].result()
+            except Exception:
+                # Sin respuesta del servidor nos quedamos con lo aplicado; el próximo delta lo corrige
+                continue
+
+            fila_srv = next((f for f in reversed(filas) if f.get('id') == p['id']), None)
+            if fila_srv is None and p['tipo'] != 'borrado':
+                # Alguien más la eliminó mientras tanto
+                borrados = borrados | {p['id']}
+            if p['tipo'] == 'borrado':
+                conflicto = fila_srv is not None
+            else:
+                conflicto = fila_srv != p['aplicado']
+
+            df = fusionar_delta(almacen.df, filas, borrados)
+            if df is None:
+                almacen.conciliaciones = []
+                sincronizar_datos(almacen, forzar=True)
+                return
+            marca = calcular_marca(df, almacen.marca)
+            marca['borrado_at'] = borrado_at
+            almacen.publicar(df, marca)
+
+            if conflicto:
+                almacen.avisos.append((p['sesion'], p['id']))
+        almacen.conciliaciones = restantes
+
+        # Cada sesión ve solo los avisos de sus propias escrituras
+        mios = [a for a in almacen.avisos if a[0] == id_sesion()]
+        almacen.avisos = [a for a in almacen.avisos if a[0] != id_sesion()]
+    for _, id_registro in mios:
+        st.toast(f"⚠️ El registro {id_registro} cambió en el servidor; se restauró la versión del servidor.")
 
 # --- CALLBACKS ---
 def form_callback():
@@ -107,31 +576,47 @@ def form_callback():
 def borrar_fuga_callback(id_registro):
     try:
         supabase.table('fugas').delete().eq('id', id_registro).execute()
-        st.session_state.dfZonas = cargar_datos()
+        mutar_dataset(almacen_fugas(), 'borrado', id_registro)
         st.success(f"Registro {id_registro} eliminado.")
     except Exception as e:
         st.error(f"Error al borrar: {e}")
 
 def registrar_fuga_callback(insert_data):
     try:
-        supabase.table('fugas').insert(insert_data).execute()
-        st.session_state.dfZonas = cargar_datos()
+        respuesta = supabase.table('fugas').insert(insert_data).execute()
+        if respuesta.data:
+            mutar_dataset(almacen_fugas(), 'alta', respuesta.data[-1]['id'], respuesta.data)
+        else:
+            sincronizar_datos(almacen_fugas())
         st.success(f"✅ Fuga registrada exitosamente.")
     except Exception as e:
         st.error(f"Error guardando registro: {e}")
 
 def actualizar_fuga_callback(id_registro, update_data):
     try:
-        supabase.table('fugas').update(update_data).eq('id', id_registro).execute()
-        st.session_state.dfZonas = cargar_datos()
+        respuesta = supabase.table('fugas').update(update_data).eq('id', id_registro).execute()
+        if not respuesta.data:
+            # Sin filas devueltas: el registro ya no existe o la política RLS bloqueó el cambio
+            sincronizar_datos(almacen_fugas(), ids_cambiados=[id_registro])
+            st.warning(f"El registro {id_registro} no se modificó en el servidor.")
+            return
+        mutar_dataset(almacen_fugas(), 'edicion', id_registro, respuesta.data)
         st.success("¡Actualizado!")
     except Exception as e:
         st.error(f"Error al actualizar: {e}")
 
-if 'dfZonas' not in st.session_state:
-    st.session_state.dfZonas = cargar_datos()
+# Cada ejecución toma la versión vigente del dataset compartido (sin copiarlo)
+almacen = almacen_fugas()
+procesar_conciliaciones(almacen)
+if almacen.vencido():
+    sincronizar_datos(almacen, si_vencido=True)
+version_datos, st.session_state.dfZonas = almacen.leer()
 
 
+def texto_o(valor, alterno=""):
+    # Texto para widgets: los nulos del esquema (NA/NaN) no deben aparecer como "<NA>"
+    return alterno if valor is None or pd.isna(valor) else str(valor)
+
 # --- 3. DIÁLOGO DE EDICIÓN ACTUALIZADO ---
 @st.dialog("✏️ Editar Registro")
 def editar_registro(index, datos_actuales):
@@ -144,7 +629,7 @@ def editar_registro(index, datos_actuales):
     cat_list_edit = list(dict_edit.keys())
 
     with col_ed1:
-        nuevo_n = st.text_input("Nombre Zona", value=str(datos_actuales['Zona']))
+        nuevo_n = st.text_input("Nombre Zona", value=texto_o(datos_actuales['Zona']))
         cat_val = datos_actuales.get('Categoria', 'Fuga A')
 
         # Validamos que la categoría exista para ese fluido
@@ -155,7 +640,7 @@ def editar_registro(index, datos_actuales):
         st.text_input("I/min", value=nueva_medida, disabled=True)
 
     with col_ed2:
-        nuevo_a = st.text_input("Área", value=str(datos_actuales.get('Area', 'N/A')))
+        nuevo_a = st.text_input("Área", value=texto_o(datos_actuales.get('Area'), 'N/A'))
         nueva_sev = st.select_slider("Severidad", options=["Baja", "Media", "Alta"], value=datos_actuales.get('Severidad', 'Media'))
 
         nuevo_costo = dict_edit[nueva_cat]["costo"]
@@ -166,22 +651,14 @@ def editar_registro(index, datos_actuales):
         nuevo_estado = st.selectbox("Estado", ["En proceso de reparar", "Dañada", "Completada"],
                                   index=["En proceso de reparar", "Dañada", "Completada"].index(datos_actuales.get('Estado', 'Dañada')) if datos_actuales.get('Estado') in ["En proceso de reparar", "Dañada", "Completada"] else 1)
 
-    nuevo_comentario = st.text_area("Comentarios / Observaciones", value=str(datos_actuales.get('Comentarios', '')), height=100)
+    nuevo_comentario = st.text_area("Comentarios / Observaciones", value=texto_o(datos_actuales.get('Comentarios')), height=100)
 
     if st.button("💾 Guardar Cambios"):
         try:
             id_registro = datos_actuales.get('id')
             
-            # Limpieza básica de l_min para ajustarse a float8
-            val_lmin = 0.0
-            try:
-                val_str = str(nueva_medida).replace('I/min', '').strip()
-                if '-' in val_str:
-                    p = val_str.split('-')
-                    val_lmin = (float(p[0]) + float(p[1]))/2
-                else:
-                    val_lmin = float(val_str)
-            except: pass
+            # l_min se guarda como float8: punto medio del rango (tabla compilada)
+            val_lmin = float(referencia_fuga(fluido_reg, nueva_cat)['l_min_medio'])
 
             update_data = {
                 'zona': nuevo_n,
@@ -226,15 +703,21 @@ def mostrar_qr(registro_actual, base_url):
     st.info("Imprime o escanea este código para acceder directamente a la ficha técnica de esta fuga desde cualquier dispositivo.")
     
     # Construimos la URL completa para el escaneo
-    target_link = f"{base_url.rstrip('/')}/?fuga_id={registro_actual['id']}"
-    
-    # Usamos la API pública y gratuita de qrserver para generar la imagen
-    qr_img_url = f"https://api.qrserver.com/v1/create-qr-code/?size=250x250&data={target_link}"
+    target_link = enlace_fuga(base_url, registro_actual['id'])
     
+    # El QR se genera localmente (sin red) y queda en caché por id y URL base
     col1, col2, col3 = st.columns([1,2,1])
     with col2:
-        st.image(qr_img_url, caption="Escanea para ir a Edición", use_container_width=True)
+        st.image(imagen_qr(base_url, registro_actual['id']), caption="Escanea para ir a Edición", use_container_width=True)
     st.code(target_link, language="text")
+    st.download_button(
+        label="💾 Descargar Etiqueta (PNG)",
+        data=partial(png_de, etiqueta_qr(registro_actual, base_url)),
+        file_name=f"Etiqueta_QR_{registro_actual['id']}.png",
+        mime="image/png",
+        on_click="ignore",
+        use_container_width=True
+    )
 
 # --- 4. CONFIGURACIÓN VISUAL ---
 # --- Configuarcion de formulas de categorias por fluido ---
@@ -278,6 +761,41 @@ categorias_list = list(RELACION_FUGAS["Aire"].keys())
 medidas_list = [v["l_min"] for v in RELACION_FUGAS["Aire"].values()]
 costos_list = [v["costo"] for v in RELACION_FUGAS["Aire"].values()]
 
+# --- TABLA COMPILADA DE RELACION_FUGAS ---
+# RELACION_FUGAS se aplana una sola vez en una tabla indexada por (fluido, categoría) con
+# el caudal mínimo, máximo y medio ya numéricos y el costo. Diálogo, formulario y dataset
+# toman de aquí caudal y costo en vez de volver a interpretar el texto "a-b".
+def compilar_relacion(relacion):
+    tabla = pd.DataFrame([
+        {'TipoFuga': fluido, 'Categoria': cat, 'l_min_txt': v['l_min'], 'costo': float(v['costo'])}
+        for fluido, cats in relacion.items() for cat, v in cats.items()
+    ])
+    partes = tabla['l_min_txt'].str.extract(r'^\s*(\d*\.?\d+)\s*(?:-\s*(\d*\.?\d+))?\s*$')
+    tabla['l_min_min'] = pd.to_numeric(partes[0], errors='coerce')
+    tabla['l_min_max'] = pd.to_numeric(partes[1], errors='coerce').fillna(tabla['l_min_min'])
+    tabla['l_min_medio'] = (tabla['l_min_min'] + tabla['l_min_max']) / 2
+    return tabla.set_index(['TipoFuga', 'Categoria']).sort_index()
+
+TABLA_FUGAS = compilar_relacion(RELACION_FUGAS)
+
+def referencia_fuga(fluido, categoria):
+    # Fila compilada (l_min_txt, costo, l_min_min, l_min_max, l_min_medio); mismo respaldo "Aire" que los widgets
+    fluido = fluido if fluido in RELACION_FUGAS else "Aire"
+    return TABLA_FUGAS.loc[(fluido, categoria)]
+
+def completar_caudal_costo(df):
+    # Una sola unión vectorizada por (fluido, categoría): caudal y costo vacíos salen de la tabla
+    if df is None or df.empty:
+        return df
+    llaves = pd.MultiIndex.from_arrays([df['TipoFuga'].astype(object), df['Categoria'].astype(object)])
+    ref = TABLA_FUGAS.reindex(llaves)
+    df = df.copy()
+    df['L_min'] = df['L_min'].fillna(pd.Series(ref['l_min_medio'].to_numpy(), index=df.index))
+    df['CostoAnual'] = df['CostoAnual'].fillna(pd.Series(ref['costo'].to_numpy(), index=df.index))
+    return df
+
+st.session_state.dfZonas = almacen.derivado("caudal", version_datos, st.session_state.dfZonas, completar_caudal_costo)
+
 FLUIDOS = {
     "Aire": {"color": "#0000FF", "emoji": "💨", "marker": "blue"},
     "Gas Natural": {"color": "#FFA500", "emoji": "🔥", "marker": "orange"},
@@ -287,6 +805,199 @@ FLUIDOS = {
     "Inspección (OK)": {"color": "#28A745", "emoji": "✅", "marker": "green"}  # Nuevo
 }
 
+# --- AGRUPACIÓN DE MARCADORES (CLUSTERS) ---
+# Con miles de fugas, un marcador por fila hace inutilizable el mapa. Por encima del
+# umbral se agrupan por (fluido, severidad) -para que un cluster no mezcle colores- y los
+# marcadores individuales solo aparecen desde ZOOM_DESAGRUPAR.
+UMBRAL_CLUSTER = 300
+ZOOM_DESAGRUPAR = 1
+
+# --- CAPA GEOJSON COMPACTA DE FUGAS ---
+# Antes cada folium.Marker llevaba ~2 KB de HTML propio (tooltip + popup). Ahora las fugas
+# viajan como una sola FeatureCollection con solo los datos (claves cortas) y el navegador
+# arma tooltip, popup e icono con una plantilla común. La usan el Mapa y el plano exportado.
+PROPIEDADES_CAPA = {
+    'id': 'id', 'TipoFuga': 't', 'Area': 'a', 'Ubicacion': 'u', 'ID_Maquina': 'm', 'Estado': 'e',
+    'Categoria': 'c', 'L_min': 'q', 'CostoAnual': 'k', 'Severidad': 's', 'Zona': 'z', 'Comentarios': 'o'
+}
+
+def coleccion_fugas(df):
+    df = df[df['lat_c'].notna()]
+    props = df[list(PROPIEDADES_CAPA)].rename(columns=PROPIEDADES_CAPA)
+    # to_json convierte NaN/None en null (json.dumps produciría NaN, que no es JSON válido)
+    registros = json.loads(props.to_json(orient='records', force_ascii=False))
+    coords = df[['lng_c', 'lat_c']].round(2).to_numpy().tolist()
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {"type": "Feature", "geometry": {"type": "Point", "coordinates": c}, "properties": p}
+            for c, p in zip(coords, registros)
+        ]
+    }
+
+def json_seguro(obj):
+    # JSON apto para ir dentro de <script> (mismo escape que el filtro tojson de Jinja)
+    return (json.dumps(obj, ensure_ascii=False)
+            .replace("<", "\\u003c").replace(">", "\\u003e")
+            .replace("&", "\\u0026").replace("'", "\\u0027"))
+
+class CapaFugas(JSCSSMixin, MacroElement):
+    _template = Template("""
+    {% macro script(this, kwargs) %}
+    (function() {
+        var datos = {{ this.datos_json }};
+        var fluidos = {{ this.fluidos|tojson }};
+        var colorSev = {"Alta": "#FF4B4B", "Media": "#FFA500", "Baja": "#28A745"};
+        var porDefecto = {"color": "white", "marker": "red", "emoji": "⚠️"};
+
+        function esc(v) {
+            if (v === null || v === undefined) { return ""; }
+            return String(v).replace(/[&<>"']/g, function(ch) {
+                return {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#39;"}[ch];
+            });
+        }
+        function val(v, alterno) { return (v === null || v === undefined) ? alterno : v; }
+
+        // Tooltip (hover)
+        function tooltip(p) {
+            var f = fluidos[p.t] || porDefecto;
+            var ubiEmoji = p.u === "Terrestre" ? "🚜" : "☁️";
+            var com = String(val(p.o, ""));
+            if (com.length > 50) { com = com.slice(0, 50) + "..."; }
+            return '<div style="background-color:#1d2129; color:white; padding:10px; border-radius:8px; border-left:5px solid ' + f.color + '; min-width:150px;">'
+                + '<b>' + f.emoji + ' ' + esc(p.a) + '</b><br>'
+                + '<span style="color:#bdc3c7; font-size:0.85em;">' + ubiEmoji + ' Instalación: ' + esc(p.u) + '</span><br>'
+                + '<span style="color:' + (colorSev[p.s] || "#333") + '; font-size:0.9em;">Severidad: ' + esc(p.s) + '</span><br>'
+                + '<span style="color:#bdc3c7; font-size:0.85em;"><i>' + esc(com) + '</i></span></div>';
+        }
+
+        // Popup (Clic): Ficha Técnica
+        function popup(p) {
+            var f = fluidos[p.t] || porDefecto;
+            var cs = colorSev[p.s] || "#333";
+            var ubiEmoji = p.u === "Terrestre" ? "🚜" : "☁️";
+            function filaTabla(etiqueta, valor, estilo) {
+                return '<tr><td><b>' + etiqueta + ':</b></td><td' + (estilo ? ' style="' + estilo + '"' : '') + '>' + valor + '</td></tr>';
+            }
+            return '<div style="font-family: \\'Segoe UI\\', sans-serif; color: #333; min-width: 250px;">'
+                + '<h4 style="margin:0 0 10px 0; color:' + f.color + '; border-bottom: 2px solid ' + cs + ';">📋 Ficha Técnica</h4>'
+                + '<table style="width:100%; font-size: 13px; border-spacing: 0 5px;">'
+                + filaTabla('ID Máquina', '<b>' + esc(val(p.m, 'N/A')) + '</b>')
+                + filaTabla('Área de Planta', esc(p.a))
+                + filaTabla('Instalación', ubiEmoji + ' ' + esc(p.u))
+                + filaTabla('Estado', '<b>' + esc(val(p.e, 'N/A')) + '</b>')
+                + filaTabla('Categoria', esc(val(p.c, 'N/A')))
+                + filaTabla('Caudal', esc(val(p.q, 'N/A')) + ' I/min')
+                + filaTabla('Costo/Año', '$' + esc(val(p.k, '0')) + ' USD', 'color:#d9534f; font-weight:bold;')
+                + filaTabla('Severidad', esc(p.s), 'color:' + cs + '; font-weight:bold;')
+                + filaTabla('Fechas', esc(p.z))
+                + '<tr><td colspan="2" style="border-top:1px solid #ddd; padding-top:5px;"><b>Comentarios:</b><br/>' + esc(val(p.o, '')) + '</td></tr>'
+                + '</table></div>';
+        }
+
+        // Icono: info-sign por defecto, ok-sign si está completada o es inspección; Alta brinca
+        function icono(p) {
+            var f = fluidos[p.t] || porDefecto;
+            return L.AwesomeMarkers.icon({
+                icon: (p.e === "Completada" || p.t === "Inspección (OK)") ? "ok-sign" : "info-sign",
+                markerColor: f.marker,
+                prefix: "glyphicon",
+                extraClasses: p.s === "Alta" ? "brinca-peppo" : ""
+            });
+        }
+
+        // Burbuja de cluster con el color del fluido; las de severidad Alta conservan el brinco
+        function iconoCluster(color, sev) {
+            return function(cluster) {
+                var n = cluster.getChildCount();
+                var d = n < 10 ? 30 : (n < 100 ? 38 : 46);
+                return L.divIcon({
+                    html: '<div style="width:' + d + 'px; height:' + d + 'px; line-height:' + (d - 6) + 'px; border-radius:50%;'
+                        + ' background:' + color + '; border:3px solid ' + (colorSev[sev] || "#333") + '; color:#111; font-weight:bold; text-align:center;'
+                        + ' text-shadow:0 0 3px #fff;">' + n + '</div>',
+                    className: 'cluster-fuga ' + (sev === "Alta" ? "brinca-peppo" : ""),
+                    iconSize: L.point(d, d)
+                });
+            };
+        }
+
+        var destino = {{ this._parent.get_name() }};
+        var grupos = {};
+        L.geoJSON(datos, {
+            pointToLayer: function(feature, latlng) {
+                return L.marker(latlng, {icon: icono(feature.properties)});
+            },
+            onEachFeature: function(feature, layer) {
+                var p = feature.properties;
+                layer.bindTooltip(function() { return tooltip(p); }, {sticky: true});
+                layer.bindPopup(function() { return popup(p); }, {maxWidth: 350});
+                if ({{ this.agrupar|tojson }}) {
+                    var llave = p.t + "|" + p.s;
+                    if (!grupos[llave]) {
+                        grupos[llave] = L.markerClusterGroup({
+                            disableClusteringAtZoom: {{ this.zoom_desagrupar }},
+                            showCoverageOnHover: false,
+                            spiderfyOnMaxZoom: true,
+                            iconCreateFunction: iconoCluster((fluidos[p.t] || porDefecto).color, p.s)
+                        }).addTo(destino);
+                    }
+                    grupos[llave].addLayer(layer);
+                } else {
+                    layer.addTo(destino);
+                }
+            }
+        });
+    })();
+    {% endmacro %}
+    """)
+
+    default_js = MarkerCluster.default_js
+    default_css = MarkerCluster.default_css
+
+    def __init__(self, coleccion, agrupar=False, zoom_desagrupar=ZOOM_DESAGRUPAR):
+        super().__init__()
+        self._name = "CapaFugas"
+        # Acepta la colección ya serializada (caché) para no volver a convertirla en cada render
+        self.datos_json = coleccion if isinstance(coleccion, str) else json_seguro(coleccion)
+        self.fluidos = FLUIDOS
+        self.agrupar = bool(agrupar)
+        self.zoom_desagrupar = int(zoom_desagrupar)
+
+# --- CAPA COMPACTA DE ZONAS (RECTÁNGULOS) ---
+# Cada folium.Rectangle compila su propia plantilla y trae su propio bloque de JS. Las zonas
+# (inspecciones del Mapa, memoria de Gestión) viajan como una lista
+# [lat_inf, lng_izq, lat_sup, lng_der, color, tooltip] y se dibujan en un solo bucle.
+def zonas_de(df, etiqueta, color=None):
+    df = df[df['lat_c'].notna()]
+    if color:
+        colores = [color] * len(df)
+    else:
+        colores = df['TipoFuga'].map(lambda t: FLUIDOS.get(t, {"color": "gray"})['color']).tolist()
+    cajas = df[['lat_inf', 'lng_izq', 'lat_sup', 'lng_der']].round(2).to_numpy().tolist()
+    textos = [html.escape(etiqueta.format(area=a, tipo=t)) for a, t in zip(df['Area'], df['TipoFuga'])]
+    return [c + [col, txt] for c, col, txt in zip(cajas, colores, textos)]
+
+class CapaZonas(MacroElement):
+    _template = Template("""
+    {% macro script(this, kwargs) %}
+    (function() {
+        var destino = {{ this._parent.get_name() }};
+        {{ this.datos_json }}.forEach(function(z) {
+            L.rectangle([[z[0], z[1]], [z[2], z[3]]], {
+                color: z[4], weight: {{ this.grosor }}, fill: true, fillOpacity: {{ this.opacidad }}
+            }).bindTooltip(z[5], {sticky: true}).addTo(destino);
+        });
+    })();
+    {% endmacro %}
+    """)
+
+    def __init__(self, zonas, grosor=2, opacidad=0.3):
+        super().__init__()
+        self._name = "CapaZonas"
+        self.datos_json = zonas if isinstance(zonas, str) else json_seguro(zonas)
+        self.grosor = int(grosor)
+        self.opacidad = float(opacidad)
+
 # --- LÓGICA DE DEEP-LINKING ---
 # Si un técnico escanea el código, la URL vendrá con ?fuga_id=XYZ
 if 'fuga_id' in st.query_params:
@@ -305,8 +1016,407 @@ if 'fuga_id' in st.query_params:
         else:
             st.error(f"❌ La Fuga ID {id_buscado} no existe o fue eliminada.")
 
-img_original = Image.open("PlanoHanon.webp")
-ancho_real, alto_real = img_original.size
+# --- ACTIVOS DEL PLANO (DECODIFICADOS UNA VEZ POR PROCESO) ---
+# Antes se abría PlanoHanon.webp en cada ejecución y el Reporte copiaba la imagen a
+# resolución completa. Ahora se decodifica una vez por proceso, con una variante reducida
+# precalculada para el plano de riesgos. Las imágenes se comparten entre sesiones: NO
+# modificarlas, usar .copy() antes de dibujar encima. Las exportaciones HTML incrustan
+# el archivo original (ruta_original) a resolución completa.
+RESOLUCIONES_PLANO = {"reporte": 2560, "full": None}  # ancho en px (None = original)
+ANCHO_VISTA_REPORTE = 1600  # Ancho máximo con el que st.image muestra el plano de riesgos
+DIR_STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
+class ActivosPlano:
+    def __init__(self, ruta):
+        original = Image.open(ruta)
+        original.load()
+        self.ruta_original = ruta
+        self.ancho, self.alto = original.size
+        self.variantes = {}
+        for nombre, ancho in RESOLUCIONES_PLANO.items():
+            if ancho is None or ancho >= self.ancho:
+                self.variantes[nombre] = original
+            else:
+                alto = round(self.alto * ancho / self.ancho)
+                self.variantes[nombre] = original.resize((ancho, alto), Image.LANCZOS)
+
+    def para_ancho(self, ancho_px):
+        # La variante más pequeña que cubre el ancho pedido (si ninguna, la original)
+        candidatas = sorted(self.variantes.values(), key=lambda img: img.width)
+        return next((img for img in candidatas if img.width >= ancho_px), candidatas[-1])
+
+@st.cache_resource
+def activos_plano():
+    return ActivosPlano("PlanoHanon.webp")
+
+activos = activos_plano()
+ancho_real, alto_real = activos.ancho, activos.alto
+
+# --- GEOMETRÍA VECTORIZADA (COORDENADAS DEL MAPA) ---
+# Las coordenadas se guardan en un lienzo de 1200 px de ancho. En vez de convertirlas
+# fila por fila en cada mapa, se calculan de una vez para todo el frame como columnas
+# float (límites y centroide en unidades del mapa, con la Y invertida).
+COLUMNAS_GEOMETRIA = ['lat_sup', 'lat_inf', 'lng_izq', 'lng_der', 'lat_c', 'lng_c']
+
+def con_geometria(df, ancho, alto):
+    if df is None or df.empty or 'x1' not in df.columns:
+        return df
+    f = ancho / 1200  # Mismo factor en X e Y (el lienzo conserva la proporción del plano)
+    x1, y1, x2, y2 = (df[c].to_numpy(dtype='float64') for c in ['x1', 'y1', 'x2', 'y2'])
+    geo = pd.DataFrame({
+        'lat_sup': alto - y1 * f,
+        'lat_inf': alto - y2 * f,
+        'lng_izq': x1 * f,
+        'lng_der': x2 * f,
+        'lat_c': alto - (y1 + y2) / 2 * f,
+        'lng_c': (x1 + x2) / 2 * f,
+    }, index=df.index)
+    return pd.concat([df, geo], axis=1)
+
+st.session_state.dfZonas = almacen.derivado(
+    "geometria", version_datos, st.session_state.dfZonas,
+    lambda d: con_geometria(d, ancho_real, alto_real), ancho_real, alto_real
+)
+
+# --- ÍNDICE ESPACIAL (REJILLA UNIFORME SOBRE x1,y1,x2,y2) ---
+# Cada caja (en el lienzo de 1200 px) se registra en las celdas que cubre. Una consulta
+# solo revisa las celdas de su propia caja. Cada versión del dataset tiene su propio
+# índice: el de la versión nueva parte de una copia del último y solo aplica las
+# diferencias, así las sesiones que aún leen otra versión nunca ven cambios a medias.
+TAM_CELDA_INDICE = 25
+
+class IndiceEspacial:
+    def __init__(self, tam_celda):
+        self.candado = threading.RLock()
+        self.tam = tam_celda
+        self.cajas = {}   # id -> (x0, y0, x1, y1)
+        self.celdas = {}  # (cx, cy) -> set(ids)
+        self.version = None
+
+    def _celdas_de(self, caja):
+        x0, y0, x1, y1 = caja
+        t = self.tam
+        for cx in range(math.floor(x0 / t), math.floor(x1 / t) + 1):
+            for cy in range(math.floor(y0 / t), math.floor(y1 / t) + 1):
+                yield (cx, cy)
+
+    def insertar(self, id_registro, caja):
+        with self.candado:
+            self.eliminar(id_registro)
+            self.cajas[id_registro] = caja
+            for celda in self._celdas_de(caja):
+                self.celdas.setdefault(celda, set()).add(id_registro)
+
+    def eliminar(self, id_registro):
+        with self.candado:
+            caja = self.cajas.pop(id_registro, None)
+            if caja is None:
+                return
+            for celda in self._celdas_de(caja):
+                ids = self.celdas.get(celda)
+                if ids is not None:
+                    ids.discard(id_registro)
+                    if not ids:
+                        del self.celdas[celda]
+
+    def consultar(self, caja):
+        # Ids cuyas cajas intersectan la caja dada (bordes incluidos), ordenados
+        x0, y0, x1, y1 = normalizar_caja(caja)
+        with self.candado:
+            candidatos = set()
+            for celda in self._celdas_de((x0, y0, x1, y1)):
+                candidatos.update(self.celdas.get(celda, ()))
+            return sorted(
+                i for i in candidatos
+                if self.cajas[i][0] <= x1 and x0 <= self.cajas[i][2]
+                and self.cajas[i][1] <= y1 and y0 <= self.cajas[i][3]
+            )
+
+    def siguiente(self, version, df):
+        # Índice nuevo para otra versión; este no se modifica
+        with self.candado:
+            if self.version == version:
+                return self
+            nuevo = IndiceEspacial(self.tam)
+            nuevo.cajas = dict(self.cajas)
+            nuevo.celdas = {celda: set(ids) for celda, ids in self.celdas.items()}
+        nuevas = cajas_de(df)
+        for i in [i for i in nuevo.cajas if i not in nuevas]:
+            nuevo.eliminar(i)
+        for i, caja in nuevas.items():
+            if nuevo.cajas.get(i) != caja:
+                nuevo.insertar(i, caja)
+        nuevo.version = version
+        return nuevo
+
+def normalizar_caja(caja):
+    x0, y0, x1, y1 = caja
+    return (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+
+def cajas_de(df):
+    # id -> caja normalizada; se omiten filas sin coordenadas numéricas
+    if df is None or df.empty or 'x1' not in df.columns:
+        return {}
+    c = df[['x1', 'y1', 'x2', 'y2']]
+    validos = c.notna().all(axis=1).to_numpy()
+    v = c.to_numpy(dtype='float64')[validos]
+    cajas = np.column_stack([
+        np.minimum(v[:, 0], v[:, 2]), np.minimum(v[:, 1], v[:, 3]),
+        np.maximum(v[:, 0], v[:, 2]), np.maximum(v[:, 1], v[:, 3])
+    ])
+    return dict(zip(df['id'][validos].tolist(), map(tuple, cajas.tolist())))
+
+@st.cache_resource
+def indice_espacial():
+    # Último índice publicado: punto de partida para la siguiente versión
+    return {'ultimo': IndiceEspacial(TAM_CELDA_INDICE)}
+
+def indice_de_version(version, df):
+    registro = indice_espacial()
+    indice = registro['ultimo'].siguiente(version, df)
+    if (registro['ultimo'].version or 0) < version:
+        registro['ultimo'] = indice
+    return indice
+
+indice_fugas = almacen.derivado(
+    "indice", version_datos, st.session_state.dfZonas,
+    lambda d: indice_de_version(version_datos, d)
+)
+
+# --- RECORTE POR VISTA (VIEWPORT) ---
+# st_folium devuelve los bounds del mapa al mover o hacer zoom. Con ellos solo se envían
+# las fugas dentro de la vista más un margen. La caja se redondea a PASO_VISTA para que
+# los desplazamientos pequeños reutilicen la misma capa de la caché.
+MARGEN_VISTA = 0.5   # Fracción del tamaño de la vista que se agrega por cada lado
+PASO_VISTA = 100     # Unidades del lienzo de 1200 px
+
+def caja_vista(estado):
+    # Caja visible en el lienzo de 1200 px, o None si no se conoce o cubre todo el plano
+    try:
+        b = estado['bounds']
+        sur, oeste = b['_southWest']['lat'], b['_southWest']['lng']
+        norte, este = b['_northEast']['lat'], b['_northEast']['lng']
+    except (TypeError, KeyError):
+        return None
+    if None in (sur, oeste, norte, este):
+        return None
+    f = 1200 / ancho_real
+    x0, x1 = oeste * f, este * f
+    y0, y1 = (alto_real - norte) * f, (alto_real - sur) * f
+    mx, my = (x1 - x0) * MARGEN_VISTA, (y1 - y0) * MARGEN_VISTA
+    caja = (
+        math.floor((x0 - mx) / PASO_VISTA) * PASO_VISTA, math.floor((y0 - my) / PASO_VISTA) * PASO_VISTA,
+        math.ceil((x1 + mx) / PASO_VISTA) * PASO_VISTA, math.ceil((y1 + my) / PASO_VISTA) * PASO_VISTA
+    )
+    if caja[0] <= 0 and caja[1] <= 0 and caja[2] >= 1200 and caja[3] >= alto_real * f:
+        return None
+    return caja
+
+def fugas_visibles(df, caja):
+    if caja is None or df.empty:
+        return df
+    return df[df['id'].isin(indice_fugas.consultar(caja))]
+
+# --- ÍNDICE DE BÚSQUEDA DEL HISTORIAL ---
+# Índice invertido por versión del dataset: cada palabra normalizada (minúsculas, sin
+# acentos) apunta a las posiciones de las filas que la contienen. Las palabras quedan
+# ordenadas, así que un prefijo es un rango contiguo (bisect) y varios términos se
+# combinan con AND intersectando posiciones.
+COLUMNAS_BUSQUEDA = ['id', 'Zona', 'ID_Maquina', 'Area', 'Comentarios']
+PATRON_PALABRA = re.compile(r'[0-9a-z]+')
+
+def normalizar_busqueda(texto):
+    texto = unicodedata.normalize('NFKD', str(texto)).encode('ascii', 'ignore').decode('ascii')
+    return texto.lower()
+
+class IndiceBusqueda:
+    def __init__(self, df):
+        cols = [c for c in COLUMNAS_BUSQUEDA if c in df.columns]
+        texto = pd.Series([''] * len(df), dtype=object)
+        for c in cols:
+            # Los nulos cuentan como texto vacío (con el dtype str de pandas, astype(str) los deja en NaN)
+            texto = texto + ' ' + df[c].astype(object).fillna('').astype(str).to_numpy(dtype=object)
+        texto = (texto.str.normalize('NFKD').str.encode('ascii', 'ignore')
+                 .str.decode('ascii').str.lower())
+        palabras = texto.str.findall(PATRON_PALABRA).explode().dropna()
+        pares = (pd.DataFrame({'palabra': palabras.to_numpy(dtype=object), 'pos': palabras.index.to_numpy()})
+                 .drop_duplicates().sort_values(['palabra', 'pos'], kind='stable'))
+        unicas, inicios = np.unique(pares['palabra'].to_numpy(dtype=object), return_index=True)
+        self.palabras = unicas.tolist()
+        self.inicios = np.append(inicios, len(pares))
+        self.posiciones = pares['pos'].to_numpy(dtype=np.int64)
+
+    def buscar(self, consulta):
+        # Posiciones de las filas donde cada término es prefijo de alguna palabra; None si no hay términos
+        terminos = PATRON_PALABRA.findall(normalizar_busqueda(consulta))
+        if not terminos:
+            return None
+        resultado = None
+        # Los términos largos suelen ser más selectivos: se intersectan primero
+        for t in sorted(set(terminos), key=len, reverse=True):
+            i0 = bisect_left(self.palabras, t)
+            i1 = bisect_left(self.palabras, t + '\uffff')
+            pos = np.unique(self.posiciones[self.inicios[i0]:self.inicios[i1]])
+            resultado = pos if resultado is None else np.intersect1d(resultado, pos, assume_unique=True)
+            if not len(resultado):
+                break
+        return resultado
+
+# --- MÁSCARAS DE FILTRO POR VERSIÓN ---
+# Por cada valor de las columnas categóricas se guarda un bitset (np.packbits) con las
+# filas que lo tienen. Un filtro es OR de los bitsets de los valores elegidos y varios
+# filtros se combinan con AND; las listas de opciones quedan calculadas de una vez.
+class FiltrosDataset:
+    def __init__(self, df):
+        self.n = len(df)
+        self.opciones = {}   # columna -> valores presentes, ordenados
+        self.bits = {}       # (columna, valor) -> bitset de filas
+        for col in COLUMNAS_CATEGORICAS:
+            if col not in df.columns:
+                continue
+            serie = df[col] if isinstance(df[col].dtype, pd.CategoricalDtype) else df[col].astype('category')
+            codigos = serie.cat.codes.to_numpy()
+            presentes = []
+            for codigo, valor in enumerate(serie.cat.categories):
+                filas = codigos == codigo
+                if filas.any():
+                    self.bits[(col, valor)] = np.packbits(filas)
+                    presentes.append(valor)
+            self.opciones[col] = sorted(presentes)
+
+    def mascara(self, **selecciones):
+        # selecciones: columna -> valores elegidos; devuelve una máscara booleana de filas
+        vacio = np.zeros((self.n + 7) // 8, dtype=np.uint8)
+        total = np.packbits(np.ones(self.n, dtype=bool))
+        for col, valores in selecciones.items():
+            elegidos = [self.bits[(col, v)] for v in valores if (col, v) in self.bits]
+            total &= reduce(np.bitwise_or, elegidos, vacio)
+        return np.unpackbits(total, count=self.n).astype(bool)
+
+def filtrar_por_fecha(df, texto):
+    # Búsqueda literal sobre 'Zona' (sin regex), igual que el WHERE de resumen_fugas:
+    # "01.05" no debe coincidir con "01/05" aquí y no en el servidor
+    if not texto or df.empty:
+        return df
+    return df[df['Zona'].str.contains(texto, case=False, regex=False, na=False)]
+
+filtros_ds = almacen.derivado("filtros", version_datos, st.session_state.dfZonas, FiltrosDataset)
+
+# --- PIRÁMIDE DE TESELAS DEL PLANO ---
+# ImageOverlay incrusta el plano completo en el HTML del mapa en cada ejecución. En su
+# lugar cortamos el plano en teselas XYZ para crs="Simple" (en el zoom z, 1 unidad del
+# mapa = 2^z px) y las servimos como estáticos (/app/static, ver .streamlit/config.toml).
+# Leaflet solo pide las teselas visibles. Si existe el plano maestro 16K se usa como
+# fuente, y sus niveles por encima del zoom 0 dan el detalle sin pixelado.
+DIR_TESELAS = os.path.join(DIR_STATIC, "teselas")
+TAM_TESELA = 256
+ZOOM_MIN, ZOOM_MAX = -2, 4
+VERSION_TESELAS = 1
+
+def guardar_tesela(img, ruta):
+    img.save(ruta, "WEBP", quality=85, method=2)
+
+def cortar_nivel(img, z, dir_nivel, tam, pool):
+    # La parte superior del plano está en lat = alto -> píxel y = -alto * 2^z,
+    # por eso las filas de teselas son negativas (de -ceil(H/tam) a -1).
+    ancho, alto = img.size
+    futuros = []
+    for tx in range(math.ceil(ancho / tam)):
+        dir_x = os.path.join(dir_nivel, str(tx))
+        os.makedirs(dir_x, exist_ok=True)
+        for ty in range(-math.ceil(alto / tam), 0):
+            top = ty * tam + alto
+            caja = (tx * tam, max(top, 0), min((tx + 1) * tam, ancho), top + tam)
+            recorte = img.crop(caja)
+            if recorte.size != (tam, tam):
+                # Teselas del borde: lo que cae fuera del plano queda transparente
+                lienzo = Image.new("RGBA", (tam, tam), (0, 0, 0, 0))
+                lienzo.paste(recorte, (0, caja[1] - top))
+                recorte = lienzo
+            futuros.append(pool.submit(guardar_tesela, recorte, os.path.join(dir_x, f"{ty}.webp")))
+    return futuros
+
+def generar_piramide(ruta_fuente, ancho_mapa, alto_mapa, dir_destino, zoom_min=ZOOM_MIN, tam=TAM_TESELA):
+    with warnings.catch_warnings():
+        # El plano 16K supera el límite anti "decompression bomb" de Pillow
+        warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+        fuente = Image.open(ruta_fuente)
+        fuente.load()
+    if fuente.mode not in ("RGB", "RGBA"):
+        fuente = fuente.convert("RGBA" if "A" in fuente.getbands() else "RGB")
+
+    # Zoom nativo: el nivel más alto que la fuente cubre sin ampliar
+    zoom_nativo = max(0, int(math.floor(math.log2(fuente.width / ancho_mapa))))
+    nivel = fuente.resize((ancho_mapa * 2 ** zoom_nativo, alto_mapa * 2 ** zoom_nativo), Image.LANCZOS)
+    del fuente
+
+    with ThreadPoolExecutor(max_workers=4, thread_name_prefix="teselas") as pool:
+        futuros = []
+        for z in range(zoom_nativo, zoom_min - 1, -1):
+            if z < zoom_nativo:
+                nivel = nivel.resize((max(1, round(ancho_mapa * 2.0 ** z)), max(1, round(alto_mapa * 2.0 ** z))), Image.LANCZOS)
+            futuros += cortar_nivel(nivel, z, os.path.join(dir_destino, str(z)), tam, pool)
+        for f in futuros:
+            f.result()  # Propaga cualquier error de escritura
+
+    return {'zoom_min': zoom_min, 'zoom_nativo': zoom_nativo, 'tam': tam}
+
+@st.cache_resource(show_spinner="Preparando teselas del plano...")
+def piramide_plano(ancho_mapa, alto_mapa):
+    ruta = "layout completo.png" if os.path.exists("layout completo.png") else "PlanoHanon.webp"
+    try:
+        stat = os.stat(ruta)
+        firma = f"{ruta}|{stat.st_size}|{stat.st_mtime_ns}|{ancho_mapa}x{alto_mapa}|{TAM_TESELA}|{ZOOM_MIN}|{VERSION_TESELAS}"
+        clave = hashlib.sha1(firma.encode()).hexdigest()[:12]
+        dir_final = os.path.join(DIR_TESELAS, clave)
+        manifiesto = os.path.join(dir_final, "manifiesto.json")
+
+        # Caché en disco: si la pirámide de esta fuente ya existe, no se regenera
+        if not os.path.exists(manifiesto):
+            dir_tmp = f"{dir_final}.tmp-{uuid.uuid4().hex[:6]}"
+            info = generar_piramide(ruta, ancho_mapa, alto_mapa, dir_tmp)
+            with open(os.path.join(dir_tmp, "manifiesto.json"), "w") as f:
+                json.dump(info, f)
+            try:
+                os.replace(dir_tmp, dir_final)
+            except OSError:
+                # Otro proceso la terminó primero
+                shutil.rmtree(dir_tmp, ignore_errors=True)
+
+        with open(manifiesto) as f:
+            info = json.load(f)
+        info['url'] = f"/app/static/teselas/{clave}/{{z}}/{{x}}/{{y}}.webp"
+        return info
+    except Exception as e:
+        st.warning(f"No se pudieron generar las teselas del plano, se usará la imagen completa: {e}")
+        return None
+
+def agregar_plano(mapa, opacidad):
+    piramide = piramide_plano(ancho_real, alto_real)
+    if piramide:
+        capa = folium.TileLayer(
+            tiles=piramide['url'],
+            attr="Plano Hanon",
+            name="Plano",
+            min_zoom=ZOOM_MIN,
+            max_zoom=ZOOM_MAX,
+            min_native_zoom=piramide['zoom_min'],
+            max_native_zoom=piramide['zoom_nativo'],
+            tile_size=piramide['tam'],
+            no_wrap=True,
+            bounds=[[0, 0], [alto_real, ancho_real]],
+            opacity=opacidad
+        )
+        # folium trata max_native_zoom=0 como "no definido" y lo sustituye por max_zoom
+        capa.options['max_native_zoom'] = piramide['zoom_nativo']
+        capa.add_to(mapa)
+    else:
+        # Sin pirámide de teselas: el plano original, como antes de las teselas
+        ImageOverlay(
+            image=activos.ruta_original,
+            bounds=[[0, 0], [alto_real, ancho_real]],
+            opacity=opacidad
+        ).add_to(mapa)
 
 # --- 5. SIDEBAR ---
 with st.sidebar:
@@ -316,17 +1426,11 @@ with st.sidebar:
     filtro_fluidos = st.multiselect("Monitorear:", list(FLUIDOS.keys()), default=list(FLUIDOS.keys()))
     # --- NUEVOS FILTROS GLOBALES ---
     # 1. Filtro por Estado
-    if not st.session_state.dfZonas.empty and 'Estado' in st.session_state.dfZonas.columns:
-        estados_disponibles = sorted(st.session_state.dfZonas['Estado'].unique())
-    else:
-        estados_disponibles = []
+    estados_disponibles = filtros_ds.opciones.get('Estado', [])
     filtro_estados = st.multiselect("Estado de Fuga:", estados_disponibles, default=estados_disponibles)
 
     # 2. Filtro por Área de Planta
-    if not st.session_state.dfZonas.empty and 'Area' in st.session_state.dfZonas.columns:
-        areas_disponibles = sorted(st.session_state.dfZonas['Area'].unique())
-    else:
-        areas_disponibles = []
+    areas_disponibles = filtros_ds.opciones.get('Area', [])
     filtro_areas = st.multiselect("Área de Planta:", areas_disponibles, default=areas_disponibles)
 
     # 3. URL Base para Códigos QR
@@ -340,13 +1444,20 @@ with st.sidebar:
     # Para un filtrado de fecha exacto, se requeriría procesar el string de 'Zona'
     busqueda_fecha = st.text_input("🔍 Buscar Fecha (ej: 2026)")
 
+    # 4. Agrupación de marcadores en el Mapa (se activa sola con muchos hallazgos)
+    umbral_cluster = st.number_input("Agrupar marcadores desde (fugas):", min_value=0, value=UMBRAL_CLUSTER, step=100,
+                                     help="Con más hallazgos visibles que este número, el mapa agrupa los marcadores por fluido y severidad hasta acercarse. 0 = agrupar siempre.")
+    vista_dinamica = st.toggle("🔭 Cargar solo la zona visible", value=True,
+                               help="Los mapas solo reciben las fugas dentro de la vista (más un margen) y se actualizan al mover o hacer zoom.")
+
     st.success("Conexión: Cloud Sync ✅")
+    memoria_mb = almacen.derivado("memoria", version_datos, st.session_state.dfZonas,
+                                  lambda d: d.memory_usage(deep=True).sum() / 1024 ** 2)
+    st.caption(f"💾 {len(st.session_state.dfZonas):,} registros · {memoria_mb:.1f} MB en memoria")
 
     if st.button("🔄 Recargar Datos (Borrar Caché)"):
-        st.cache_resource.clear()
-        st.cache_data.clear()
-        if 'dfZonas' in st.session_state:
-            del st.session_state['dfZonas']
+        # Solo se invalida el dataset de fugas; la conexión compartida se conserva
+        sincronizar_datos(almacen, forzar=True, reiniciar=True)
         st.rerun()
 
     # --- FIRMA DE AUTOR (Movida al Sidebar) ---
@@ -359,18 +1470,693 @@ with st.sidebar:
     """, unsafe_allow_html=True)
 
 # --- Lógica de Triple Filtrado ---
+# (intersección de bitsets cacheados por versión en lugar de tres isin sobre texto)
 if not st.session_state.dfZonas.empty and 'TipoFuga' in st.session_state.dfZonas.columns:
     df_filtrado = st.session_state.dfZonas[
-        (st.session_state.dfZonas['TipoFuga'].isin(filtro_fluidos)) &
-        (st.session_state.dfZonas['Estado'].isin(filtro_estados)) &
-        (st.session_state.dfZonas['Area'].isin(filtro_areas))
+        filtros_ds.mascara(TipoFuga=filtro_fluidos, Estado=filtro_estados, Area=filtro_areas)
     ]
 else:
     df_filtrado = pd.DataFrame(columns=st.session_state.dfZonas.columns)
 
 # Aplicar búsqueda de fecha si el usuario escribió algo
-if busqueda_fecha and not df_filtrado.empty:
-    df_filtrado = df_filtrado[df_filtrado['Zona'].str.contains(busqueda_fecha, case=False, na=False)]
+df_filtrado = filtrar_por_fecha(df_filtrado, busqueda_fecha)
+
+# Clave del resultado filtrado: versión del dataset + filtros globales
+clave_filtros = (
+    version_datos,
+    tuple(sorted(filtro_fluidos)), tuple(sorted(filtro_estados)), tuple(sorted(filtro_areas)),
+    busqueda_fecha
+)
+
+# --- CACHÉ DE MAPAS CONSTRUIDOS (LRU ACOTADA POR MEMORIA) ---
+# Reconstruir el mapa completo (plano, CSS, rectángulos, capa de fugas) en cada rerun
+# es trabajo perdido si ni los datos ni los filtros cambiaron. Los mapas se guardan en
+# una LRU compartida por proceso, con clave (versión, filtros, modo) y tamaño estimado;
+# el Mapa en vivo y el plano exportado comparten la misma colección GeoJSON.
+MAX_BYTES_MAPAS = 64 * 1024 * 1024
+
+# Animación (Brinco/Pulso) para los iconos con la clase 'brinca-peppo'
+ESTILO_MARCADORES = """
+<style>
+@keyframes bounce {
+    0%, 20%, 50%, 80%, 100% {transform: translateY(0);}
+    40% {transform: translateY(-10px);}
+    60% {transform: translateY(-5px);}
+}
+.brinca-peppo {
+    animation: bounce 2s infinite;
+}
+</style>
+"""
+
+class CacheLRU:
+    def __init__(self, max_bytes):
+        self.candado = threading.Lock()
+        self.max_bytes = max_bytes
+        self.entradas = OrderedDict()
+        self.bytes = 0
+
+    def obtener(self, clave, construir):
+        # construir() devuelve (valor, tamaño en bytes)
+        with self.candado:
+            if clave in self.entradas:
+                self.entradas.move_to_end(clave)
+                return self.entradas[clave][0]
+        valor, tamano = construir()
+        with self.candado:
+            if clave not in self.entradas:
+                self.entradas[clave] = (valor, tamano)
+                self.bytes += tamano
+                # Expulsamos los menos usados, conservando siempre el recién creado
+                while self.bytes > self.max_bytes and len(self.entradas) > 1:
+                    _, (_, t) = self.entradas.popitem(last=False)
+                    self.bytes -= t
+            return self.entradas[clave][0]
+
+@st.cache_resource
+def cache_mapas():
+    return CacheLRU(MAX_BYTES_MAPAS)
+
+def coleccion_filtrada(df, clave):
+    # (GeoJSON serializado, zonas de inspección serializadas, número de fugas)
+    def construir():
+        coleccion = coleccion_fugas(df)
+        datos_json = json_seguro(coleccion)
+        zonas_json = json_seguro(zonas_de(df[df['TipoFuga'] == "Inspección (OK)"], "Zona Inspeccionada: {area}", "#28A745"))
+        return (datos_json, zonas_json, len(coleccion['features'])), len(datos_json) + len(zonas_json)
+    return cache_mapas().obtener(('coleccion',) + clave, construir)
+
+def mapa_base(modo='vivo', opacidad=0.8):
+    m = folium.Map(
+        location=[alto_real / 2, ancho_real / 2],
+        zoom_start=-1, # Inicio con vista general
+        crs="Simple",
+        tiles=None,    # Sin mapa base: el plano llega como teselas propias
+        min_zoom=ZOOM_MIN,   # Permite alejar para ver todo el plano
+        max_zoom=ZOOM_MAX     # Permite mucho acercamiento
+    )
+    m.get_root().header.add_child(folium.Element(ESTILO_MARCADORES))
+
+    if modo == 'export':
+        # El HTML descargado debe funcionar sin el servidor, así que aquí el plano
+        # se incrusta a resolución completa en lugar de usar las teselas
+        ImageOverlay(
+            image=activos.ruta_original,
+            bounds=[[0, 0], [alto_real, ancho_real]],
+            opacity=opacidad
+        ).add_to(m)
+    else:
+        agregar_plano(m, opacidad=opacidad)
+    return m
+
+def construir_mapa(coleccion, zonas, modo, agrupar):
+    m = mapa_base(modo)
+    if modo != 'export':
+        # Zonas marcadas como "Inspección (OK)" en verde, con baja opacidad para no tapar mucho
+        CapaZonas(zonas, grosor=1, opacidad=0.2).add_to(m)
+
+    # Una sola capa GeoJSON; por encima del umbral se agrupa por fluido y severidad
+    CapaFugas(coleccion, agrupar=agrupar).add_to(m)
+    return m
+
+def mapa_fugas(df, clave, modo, umbral):
+    coleccion, zonas, n_fugas = coleccion_filtrada(df, clave)
+    agrupar = n_fugas > umbral
+    def construir():
+        # El mapa retiene la colección aunque su entrada propia salga de la LRU,
+        # así que se cuenta también aquí (estimación conservadora). Un ImageOverlay
+        # (exportación o respaldo sin teselas) guarda el plano entero como data URL.
+        m = construir_mapa(coleccion, zonas, modo, agrupar)
+        plano = sum(len(c.url) for c in m._children.values() if isinstance(c, ImageOverlay))
+        return m, len(coleccion) + len(zonas) + plano + 64 * 1024
+    return cache_mapas().obtener(('mapa', modo, agrupar, ancho_real, alto_real) + clave, construir)
+
+def capa_vista(df, clave, umbral):
+    # Capa con solo las fugas de la vista; st_folium la cambia sin recrear el mapa base
+    coleccion, zonas, n_fugas = coleccion_filtrada(df, clave)
+    capa = folium.FeatureGroup(name="Fugas visibles")
+    CapaZonas(zonas, grosor=1, opacidad=0.2).add_to(capa)
+    CapaFugas(coleccion, agrupar=n_fugas > umbral).add_to(capa)
+    return capa
+
+# --- PLANO DE RIESGOS (CAPA DE RECTÁNGULOS INCREMENTAL) ---
+# Los rectángulos viven en una capa transparente del tamaño de la vista. Al cambiar
+# la versión del dataset solo se repintan las regiones de las fugas que cambiaron;
+# el compuesto final se codifica una vez y se sirve hasta el siguiente cambio.
+CALIDAD_JPEG_RIESGOS = 85
+
+class CapaRiesgos:
+    def __init__(self, base, ancho_plano):
+        self.candado = threading.Lock()
+        self.base = base.convert("RGBA")
+        self.capa = Image.new("RGBA", base.size, (0, 0, 0, 0))
+        self.sc = base.width / 1200
+        self.grosor = max(2, round(25 * base.width / ancho_plano))
+        self.rects = {}      # id -> (caja en píxeles enteros, color)
+        self.version = None
+        self.imagen = None   # Compuesto codificado (JPEG)
+
+    def _rects_de(self, df):
+        coords = df[['x1', 'y1', 'x2', 'y2']].astype('float64') * self.sc
+        validos = coords.notna().all(axis=1).to_numpy()
+        v = coords.to_numpy()[validos].round().astype(int)
+        # Cajas normalizadas (PIL exige x0 <= x1); enteras para que el recorte sea exacto
+        cajas = np.column_stack([
+            np.minimum(v[:, 0], v[:, 2]), np.minimum(v[:, 1], v[:, 3]),
+            np.maximum(v[:, 0], v[:, 2]), np.maximum(v[:, 1], v[:, 3])
+        ])
+        colores = df['TipoFuga'][validos].map(lambda t: FLUIDOS.get(t, {"color": "#FFFFFF"})['color'])
+        ids = df['id'][validos].tolist()
+        return dict(zip(ids, zip(map(tuple, cajas.tolist()), colores.tolist())))
+
+    def _pintar(self, lienzo, rects, origen=(0, 0)):
+        d = ImageDraw.Draw(lienzo)
+        ox, oy = origen
+        ancho, alto = lienzo.size
+        g = self.grosor
+        for (x0, y0, x1, y1), color in rects.values():
+            # Solo lo que toca el lienzo (con margen: si el borde es más grueso que
+            # media caja, PIL pinta fuera de ella); PIL recorta el resto
+            if x1 + g >= ox and x0 - g < ox + ancho and y1 + g >= oy and y0 - g < oy + alto:
+                d.rectangle((x0 - ox, y0 - oy, x1 - ox, y1 - oy), outline=color, width=self.grosor)
+
+    def _repintar_region(self, caja, rects):
+        ancho, alto = self.capa.size
+        g = self.grosor
+        x0, y0 = max(0, caja[0] - g), max(0, caja[1] - g)
+        x1, y1 = min(ancho, caja[2] + g + 1), min(alto, caja[3] + g + 1)
+        if x0 >= x1 or y0 >= y1:
+            return
+        sub = Image.new("RGBA", (x1 - x0, y1 - y0), (0, 0, 0, 0))
+        self._pintar(sub, rects, (x0, y0))
+        self.capa.paste(sub, (x0, y0))
+
+    def actualizar(self, version, df):
+        with self.candado:
+            if self.version == version and self.imagen is not None:
+                return self.imagen
+            nuevos = self._rects_de(df)
+            cambiados = [i for i in self.rects.keys() | nuevos.keys() if self.rects.get(i) != nuevos.get(i)]
+            if self.version is None or len(cambiados) > max(50, len(nuevos) // 4):
+                # Primera vez o demasiados cambios: repintado completo
+                self.capa = Image.new("RGBA", self.capa.size, (0, 0, 0, 0))
+                self._pintar(self.capa, nuevos)
+            else:
+                # Un rectángulo solo afecta píxeles dentro de su caja: basta con
+                # limpiar la caja vieja y la nueva y repintar lo que las cruza
+                for i in cambiados:
+                    for rect in (self.rects.get(i), nuevos.get(i)):
+                        if rect is not None:
+                            self._repintar_region(rect[0], nuevos)
+            self.rects = nuevos
+            buf = io.BytesIO()
+            Image.alpha_composite(self.base, self.capa).convert("RGB").save(
+                buf, format="JPEG", quality=CALIDAD_JPEG_RIESGOS)
+            self.imagen = buf.getvalue()
+            self.version = version
+            return self.imagen
+
+    def png(self, version, df):
+        # Compuesto sin pérdida para descargar; se codifica a petición, no se guarda
+        self.actualizar(version, df)
+        with self.candado:
+            buf = io.BytesIO()
+            Image.alpha_composite(self.base, self.capa).convert("RGB").save(buf, format="PNG")
+            return buf.getvalue()
+
+def capa_riesgos(clave, ancho_vista):
+    def construir():
+        base = activos.para_ancho(ancho_vista)
+        if base.width != ancho_vista:
+            base = base.resize((ancho_vista, round(base.height * ancho_vista / base.width)), Image.LANCZOS)
+        capa = CapaRiesgos(base, ancho_real)
+        # Base + capa RGBA + imagen codificada (estimación)
+        return capa, base.width * base.height * 9
+    # Una capa por combinación de filtros; la versión se resuelve dentro, de forma incremental
+    return cache_mapas().obtener(('riesgos', ancho_vista) + tuple(clave[1:]), construir)
+
+def plano_riesgos(df, clave, ancho_vista):
+    return capa_riesgos(clave, ancho_vista).actualizar(clave[0], df)
+
+# --- CUBO DE KPIs ---
+# Un solo groupby por versión del dataset: conteo y costo por fluido x estado x área x
+# severidad x categoría. Los filtros globales son dimensiones del cubo, así que métricas y
+# gráficas se responden rebanándolo (costo proporcional al número de grupos, no de filas).
+DIMENSIONES_CUBO = ['TipoFuga', 'Estado', 'Area', 'Severidad', 'Categoria']
+
+def construir_cubo(df):
+    return (df.groupby(DIMENSIONES_CUBO, observed=True, dropna=False)
+              .agg(n=('id', 'size'), costo=('CostoAnual', 'sum'))
+              .reset_index())
+
+def cubo_kpi(df_filtrado, clave):
+    version, fluidos, estados, areas, fecha = clave
+    if fecha:
+        # La búsqueda por fecha es texto libre sobre 'Zona' (no es dimensión): se agrega el subconjunto
+        def construir():
+            cubo = construir_cubo(df_filtrado)
+            return cubo, int(cubo.memory_usage(deep=True).sum())
+        return cache_mapas().obtener(('cubo',) + clave, construir)
+    cubo = almacen.derivado("cubo", version, st.session_state.dfZonas, construir_cubo)
+    return cubo[cubo['TipoFuga'].isin(fluidos) & cubo['Estado'].isin(estados) & cubo['Area'].isin(areas)]
+
+def suma_por(cubo, dimensiones, medida='n', dropna=False):
+    # Los nulos de una dimensión forman su propio grupo, como en construir_cubo
+    return cubo.groupby(dimensiones, observed=True, dropna=dropna)[medida].sum().reset_index()
+
+# --- AGREGACIÓN EN EL SERVIDOR (REPORTE) ---
+# El Reporte solo necesita totales agrupados. La función resumen_fugas (ver
+# supabase/migrations) agrupa en Postgres con los filtros del sidebar como WHERE y
+# devuelve el mismo cubo en unos cuantos KB. Si la función no existe o falla, se usa el
+# cubo local y no se vuelve a intentar hasta pasado REINTENTO_RPC. Como el dataset local
+# (completar_caudal_costo), el servidor toma el costo vacío de TABLA_FUGAS, que viaja
+# con cada llamada para que ambos caminos sumen lo mismo.
+REINTENTO_RPC = 300  # segundos
+COLUMNAS_RESUMEN = {
+    'tipo_fuga': 'TipoFuga', 'estado': 'Estado', 'area': 'Area',
+    'severidad': 'Severidad', 'categoria': 'Categoria'
+}
+COSTOS_REFERENCIA = [
+    {'tipo_fuga': fluido, 'categoria': cat, 'costo': float(costo)}
+    for (fluido, cat), costo in TABLA_FUGAS['costo'].items()
+]
+SQL_RESUMEN = """
+    WITH costos(tipo_fuga, categoria, costo) AS (VALUES {costos})
+    SELECT f.tipo_fuga, f.estado, f.area, f.severidad, f.categoria,
+           COUNT(*) AS n, COALESCE(SUM(COALESCE(f.costo_anual, c.costo)), 0) AS costo
+    FROM {tabla} f
+    LEFT JOIN costos c ON c.tipo_fuga = f.tipo_fuga AND c.categoria = f.categoria
+    WHERE f.tipo_fuga IN ({fluidos}) AND f.estado IN ({estados}) AND f.area IN ({areas})
+      AND (? IS NULL OR instr(lower(f.zona), lower(?)) > 0)
+    GROUP BY f.tipo_fuga, f.estado, f.area, f.severidad, f.categoria
+"""
+
+def resumen_supabase(fluidos, estados, areas, fecha):
+    return supabase.rpc("resumen_fugas", {
+        "fluidos": list(fluidos), "estados": list(estados), "areas": list(areas), "fecha": fecha or None,
+        "costos": COSTOS_REFERENCIA
+    }).execute().data
+
+def resumen_sqlite(ruta, tabla="fugas"):
+    # Sustituto local de la RPC (mismo contrato que resumen_supabase) para comparar
+    # sin conexión contra el cubo de pandas
+    def marcas(valores):
+        return ", ".join("?" * len(valores)) or "NULL"
+
+    def resumen(fluidos, estados, areas, fecha):
+        sql = SQL_RESUMEN.format(tabla=tabla, costos=", ".join(["(?, ?, ?)"] * len(COSTOS_REFERENCIA)),
+                                 fluidos=marcas(fluidos), estados=marcas(estados), areas=marcas(areas))
+        costos = [v for c in COSTOS_REFERENCIA for v in (c['tipo_fuga'], c['categoria'], c['costo'])]
+        params = [*costos, *fluidos, *estados, *areas, fecha or None, fecha or None]
+        with closing(sqlite3.connect(ruta)) as con:
+            con.row_factory = sqlite3.Row
+            return [dict(r) for r in con.execute(sql, params)]
+
+    return resumen
+
+def cubo_desde_resumen(filas):
+    cubo = pd.DataFrame(filas, columns=list(COLUMNAS_RESUMEN) + ['n', 'costo']).rename(columns=COLUMNAS_RESUMEN)
+    return cubo.astype({'n': 'int64', 'costo': 'float64'})
+
+@st.cache_resource
+def estado_rpc_resumen():
+    return {'fallo_en': None}
+
+def cubo_reporte(df_filtrado, clave, resumen=None):
+    # Cubo del Reporte calculado en el servidor; respaldo: el cubo local de la versión
+    resumen = resumen or (resumen_supabase if supabase else None)
+    estado = estado_rpc_resumen()
+    if resumen and (estado['fallo_en'] is None or time.monotonic() - estado['fallo_en'] > REINTENTO_RPC):
+        version, fluidos, estados, areas, fecha = clave
+        def construir():
+            cubo = cubo_desde_resumen(resumen(fluidos, estados, areas, fecha))
+            return cubo, int(cubo.memory_usage(deep=True).sum())
+        try:
+            return cache_mapas().obtener(('resumen',) + clave, construir)
+        except Exception:
+            estado['fallo_en'] = time.monotonic()
+    return cubo_kpi(df_filtrado, clave)
+
+# --- EXPORTACIONES BAJO DEMANDA ---
+# Las descargas del Reporte ya no se generan en cada rerun: el botón recibe una función
+# que Streamlit ejecuta solo al hacer clic. Los bytes se guardan en una LRU propia con
+# clave (versión, filtros, formato), así repetir la descarga (desde cualquier sesión)
+# no vuelve a serializar nada. Parquet siempre está disponible (pyarrow llega con
+# Streamlit); Excel solo si openpyxl está instalado.
+MAX_BYTES_EXPORTES = 64 * 1024 * 1024
+EXCEL_DISPONIBLE = importlib.util.find_spec("openpyxl") is not None
+ANCHO_EXPORT_RIESGOS = RESOLUCIONES_PLANO["reporte"]
+
+FORMATOS_DATOS = {
+    'csv': ("📊 Datos (CSV)", "Reporte_Fugas.csv", "text/csv"),
+    'parquet': ("🧱 Parquet", "Reporte_Fugas.parquet", "application/vnd.apache.parquet"),
+    'xlsx': ("📗 Excel", "Reporte_Fugas.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
+
+@st.cache_resource
+def cache_exportes():
+    return CacheLRU(MAX_BYTES_EXPORTES)
+
+def exportacion(clave, construir):
+    # construir() devuelve los bytes del archivo
+    def medir():
+        datos = construir()
+        return datos, len(datos)
+    return cache_exportes().obtener(clave, medir)
+
+def tabla_exportable(df):
+    # Saneado: sin coordenadas, 'Zona' como 'Fechas' y caudal/costo vacíos como 0
+    tabla = df.drop(columns=['x1', 'y1', 'x2', 'y2'] + COLUMNAS_GEOMETRIA + COLUMNAS_FECHA, errors='ignore')
+    tabla = tabla.rename(columns={'Zona': 'Fechas'})
+    tabla[['L_min', 'CostoAnual']] = tabla[['L_min', 'CostoAnual']].fillna(0)
+    return tabla
+
+def exportar_datos(df, clave, formato):
+    def construir():
+        tabla = tabla_exportable(df)
+        if formato == 'csv':
+            return tabla.to_csv(index=False).encode('utf-8')
+        buffer = io.BytesIO()
+        if formato == 'parquet':
+            tabla.to_parquet(buffer, index=False)
+        else:
+            # openpyxl no entiende pd.NA: las celdas vacías se escriben como None
+            tabla.astype(object).where(tabla.notna(), None).to_excel(buffer, index=False, sheet_name="Fugas")
+        return buffer.getvalue()
+    return exportacion(('datos', formato) + clave, construir)
+
+def html_reporte(chart_json):
+    # Plantilla HTML con estilos profesionales (Dark Theme & Glassmorphism)
+    return f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+      <title>Leak Hunter | Executive Report</title>
+      <script src="https://cdn.jsdelivr.net/npm/vega@5"></script>
+      <script src="https://cdn.jsdelivr.net/npm/vega-lite@5"></script>
+      <script src="https://cdn.jsdelivr.net/npm/vega-embed@6"></script>
+      <style>
+        body {{
+          background-color: #0e1117;
+          color: #fafafa;
+          font-family: 'Segoe UI', Roboto, Helvetica, Arial, sans-serif;
+          display: flex;
+          flex-direction: column;
+          align-items: center;
+          padding: 40px;
+          margin: 0;
+        }}
+        .container {{
+          max-width: 1200px;
+          width: 100%;
+        }}
+        .header {{
+          text-align: center;
+          padding: 30px;
+          background: linear-gradient(135deg, #161a22 0%, #1d2129 100%);
+          border-radius: 20px;
+          border: 1px solid #2d323d;
+          margin-bottom: 30px;
+          box-shadow: 0 10px 30px rgba(0,0,0,0.5);
+        }}
+        .header h1 {{ margin: 0; color: #5271ff; font-size: 2.5em; letter-spacing: -1px; }}
+        .header p {{ color: #888; margin-top: 10px; font-size: 1.1em; }}
+        #vis {{
+          background: #161a22;
+          padding: 30px;
+          border-radius: 20px;
+          border: 1px solid #2d323d;
+          box-shadow: 0 10px 30px rgba(0,0,0,0.5);
+          overflow-x: auto;
+        }}
+        .footer {{
+          margin-top: 50px;
+          text-align: center;
+          color: #444;
+          font-size: 0.9em;
+          border-top: 1px solid #2d323d;
+          padding-top: 20px;
+          width: 100%;
+        }}
+      </style>
+    </head>
+    <body>
+      <div class="container">
+        <div class="header">
+          <h1>🏭 Leak Hunter Report</h1>
+          <p>Monitoring Dashboard | Industrial Digital Twin Report</p>
+        </div>
+        <div id="vis"></div>
+        <div class="footer">
+          Developed by Master Engineer Erik Armenta &copy; 2026
+        </div>
+      </div>
+      <script>
+        const spec = {chart_json};
+        vegaEmbed('#vis', spec, {{
+          mode: "vega-lite",
+          theme: "dark",
+          actions: true
+        }}).then(console.log).catch(console.warn);
+      </script>
+    </body>
+    </html>
+    """
+
+def exportar_reporte(grafica, clave):
+    # La gráfica unificada solo depende del cubo, es decir, de (versión, filtros)
+    return exportacion(('reporte',) + clave, lambda: html_reporte(grafica.to_json()).encode('utf-8'))
+
+def exportar_mapa(df, clave, umbral):
+    # El HTML se renderiza en memoria (nada de archivos compartidos entre sesiones) y se
+    # guarda por contenido: la clave es el sha256 de lo que lo determina (colección,
+    # zonas, agrupación y tamaño del plano), así filtros distintos que dejan las mismas
+    # fugas, en cualquier sesión, reciben los mismos bytes.
+    coleccion, zonas, n_fugas = coleccion_filtrada(df, clave)
+    agrupar = n_fugas > umbral
+    huella = hashlib.sha256()
+    for parte in (coleccion, zonas, repr((agrupar, ancho_real, alto_real))):
+        huella.update(parte.encode('utf-8'))
+    def construir():
+        # Mismo constructor que el Mapa en vivo (plano incrustado en vez de teselas). El
+        # folium.Map no pasa por cache_mapas: solo se guardan los bytes, una vez por export
+        return construir_mapa(coleccion, zonas, 'export', agrupar).get_root().render().encode('utf-8')
+    return exportacion(('mapa', huella.hexdigest()), construir)
+
+def exportar_riesgos(df, clave):
+    # Plano de riesgos en PNG a la resolución de la variante "reporte"
+    return exportacion(('riesgos',) + clave, lambda: capa_riesgos(clave, ANCHO_EXPORT_RIESGOS).png(clave[0], df))
+
+# --- COLA DE TRABAJOS EN SEGUNDO PLANO ---
+# Las exportaciones pesadas (plano de riesgos, mapa interactivo, reporte HTML) corren
+# en un pool compartido por proceso, no en el hilo del script: la sesión envía el
+# trabajo y un fragment consulta su avance. Un trabajo se identifica por sus entradas,
+# así que pedir lo mismo (desde cualquier sesión) se une al trabajo que ya existe, en
+# cola, en curso o terminado. Los artefactos se conservan TTL_TRABAJOS segundos y la
+# cola guarda espera y duración de los últimos trabajos para dimensionar el pool.
+HILOS_TRABAJOS = 2
+TTL_TRABAJOS = 600        # segundos
+INTERVALO_SONDEO = 1.0    # segundos entre consultas de avance
+MUESTRAS_METRICAS = 200
+
+class ColaTrabajos:
+    def __init__(self, hilos, ttl):
+        self.candado = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="trabajos")
+        self.hilos = hilos
+        self.ttl = ttl
+        self.trabajos = {}   # clave -> estado del trabajo
+        self.esperas = deque(maxlen=MUESTRAS_METRICAS)
+        self.duraciones = deque(maxlen=MUESTRAS_METRICAS)
+
+    def _purgar(self, ahora):
+        vencidos = [c for c, t in self.trabajos.items() if t['fin'] is not None and ahora - t['fin'] > self.ttl]
+        for c in vencidos:
+            del self.trabajos[c]
+
+    def enviar(self, clave, fn):
+        # fn(avance) devuelve los bytes del artefacto; avance(fracción, texto) informa el progreso
+        with self.candado:
+            ahora = time.monotonic()
+            self._purgar(ahora)
+            trabajo = self.trabajos.get(clave)
+            if trabajo is not None and trabajo['estado'] != 'error':
+                return dict(trabajo)
+            trabajo = {'estado': 'en cola', 'progreso': 0.0, 'texto': "En cola...", 'datos': None,
+                       'error': None, 'creado': ahora, 'inicio': None, 'fin': None}
+            self.trabajos[clave] = trabajo
+            self.pool.submit(self._ejecutar, trabajo, fn)
+            return dict(trabajo)
+
+    def _ejecutar(self, trabajo, fn):
+        def avance(fraccion, texto):
+            with self.candado:
+                trabajo['progreso'], trabajo['texto'] = fraccion, texto
+        with self.candado:
+            trabajo['estado'], trabajo['inicio'] = 'en curso', time.monotonic()
+            self.esperas.append(trabajo['inicio'] - trabajo['creado'])
+        try:
+            datos, error = fn(avance), None
+        except Exception as e:
+            datos, error = None, str(e)
+        with self.candado:
+            trabajo['datos'], trabajo['error'] = datos, error
+            trabajo['estado'] = 'error' if error else 'listo'
+            trabajo['progreso'], trabajo['fin'] = 1.0, time.monotonic()
+            self.duraciones.append(trabajo['fin'] - trabajo['inicio'])
+
+    def consultar(self, clave):
+        with self.candado:
+            self._purgar(time.monotonic())
+            trabajo = self.trabajos.get(clave)
+            return dict(trabajo) if trabajo else None
+
+    def pendiente(self, clave):
+        trabajo = self.consultar(clave)
+        return trabajo is not None and trabajo['estado'] in ('en cola', 'en curso')
+
+    def metricas(self):
+        with self.candado:
+            estados = [t['estado'] for t in self.trabajos.values()]
+            duraciones = sorted(self.duraciones)
+            return {
+                'en_cola': estados.count('en cola'),
+                'en_curso': estados.count('en curso'),
+                'hilos': self.hilos,
+                'espera_media': sum(self.esperas) / len(self.esperas) if self.esperas else 0.0,
+                'duracion_media': sum(duraciones) / len(duraciones) if duraciones else 0.0,
+                'duracion_p95': duraciones[math.ceil(0.95 * len(duraciones)) - 1] if duraciones else 0.0,
+            }
+
+@st.cache_resource
+def cola_trabajos():
+    return ColaTrabajos(HILOS_TRABAJOS, TTL_TRABAJOS)
+
+def trabajo_riesgos(df, clave, umbral, grafica, avance):
+    avance(0.1, "Pintando zonas sobre el plano...")
+    return exportar_riesgos(df, clave)
+
+def trabajo_reporte(df, clave, umbral, grafica, avance):
+    avance(0.1, "Serializando gráficas...")
+    return exportar_reporte(grafica, clave)
+
+def trabajo_mapa(df, clave, umbral, grafica, avance):
+    avance(0.1, "Preparando la colección de fugas...")
+    coleccion_filtrada(df, clave)
+    avance(0.4, "Construyendo y renderizando el mapa...")
+    return exportar_mapa(df, clave, umbral)
+
+# tipo -> (etiqueta, archivo, mime, función del trabajo)
+EXPORTES_PESADOS = {
+    'riesgos': ("🖼️ Plano de Riesgos (PNG)", "Plano_Riesgos.png", "image/png", trabajo_riesgos),
+    'reporte': ("📈 Leak Hunter | Executive Report", "Dashboard_Interactivo_LeakHunter.html", "text/html", trabajo_reporte),
+    'mapa': ("🗺️ Plano Interactivo", "Mapa_Interactivo.html", "text/html", trabajo_mapa),
+}
+
+def claves_exportes(clave, umbral):
+    # Solo el mapa depende del umbral de agrupación
+    return {tipo: (tipo,) + clave + ((umbral,) if tipo == 'mapa' else ()) for tipo in EXPORTES_PESADOS}
+
+# --- ETIQUETAS QR (GENERACIÓN LOCAL) ---
+# Los códigos QR se generan en el servidor con qrcode en lugar de pedirlos a un servicio
+# externo: funcionan sin internet en planta y se guardan en una LRU por (URL base, id).
+# En lote se arman hojas imprimibles (PNG o PDF) repartiendo las hojas entre un pool de
+# hilos; el lote corre como un trabajo más de la cola de trabajos.
+MAX_BYTES_QR = 16 * 1024 * 1024
+CAJA_QR = 8                      # píxeles por módulo del QR
+HILOS_ETIQUETAS = 4
+MAX_ETIQUETAS_LOTE = 1200
+DPI_ETIQUETAS = 150
+HOJA_ETIQUETAS = (1240, 1754)    # A4 a 150 DPI
+REJILLA_ETIQUETAS = (3, 5)       # columnas x filas por hoja
+MARGEN_HOJA = 60
+
+@st.cache_resource
+def cache_qr():
+    return CacheLRU(MAX_BYTES_QR)
+
+@st.cache_resource
+def pool_etiquetas():
+    return ThreadPoolExecutor(max_workers=HILOS_ETIQUETAS, thread_name_prefix="etiquetas")
+
+@st.cache_resource
+def fuentes_etiquetas():
+    return ImageFont.load_default(size=26), ImageFont.load_default(size=20)
+
+def enlace_fuga(base_url, id_fuga):
+    return f"{base_url.rstrip('/')}/?fuga_id={id_fuga}"
+
+def imagen_qr(base_url, id_fuga):
+    # Imagen en escala de grises; compartida entre sesiones: NO modificarla
+    def construir():
+        qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=CAJA_QR, border=2)
+        qr.add_data(enlace_fuga(base_url, id_fuga))
+        qr.make(fit=True)
+        img = qr.make_image(fill_color="black", back_color="white").get_image().convert("L")
+        return img, img.width * img.height
+    return cache_qr().obtener((base_url.rstrip('/'), int(id_fuga)), construir)
+
+def png_de(img):
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+def etiqueta_qr(registro, base_url, tamano=None):
+    # QR centrado con el id, la máquina y el área debajo
+    ancho, alto = tamano or (HOJA_ETIQUETAS[0] // REJILLA_ETIQUETAS[0], HOJA_ETIQUETAS[0] // REJILLA_ETIQUETAS[0])
+    fuente, fuente_chica = fuentes_etiquetas()
+    etiqueta = Image.new("L", (ancho, alto), 255)
+    qr = imagen_qr(base_url, registro['id'])
+    # Escala a un número entero de píxeles por módulo para que el código siga nítido
+    modulos = qr.width // CAJA_QR
+    lado = max(1, min(CAJA_QR, (ancho - 20) // modulos, (alto - 80) // modulos)) * modulos
+    if lado != qr.width:
+        qr = qr.resize((lado, lado), Image.NEAREST)
+    etiqueta.paste(qr, ((ancho - lado) // 2, 8))
+    draw = ImageDraw.Draw(etiqueta)
+    detalle = " | ".join(t for t in (texto_o(registro.get('ID_Maquina'), 'N/A'), texto_o(registro.get('Area'))) if t)
+    lineas = [(f"Fuga #{registro['id']}", fuente), (detalle, fuente_chica)]
+    y = lado + 14
+    for texto, f in lineas:
+        draw.text((ancho // 2, y), texto, fill=0, font=f, anchor="mt")
+        y += 30
+    return etiqueta
+
+def hoja_de_etiquetas(registros, base_url):
+    hoja = Image.new("L", HOJA_ETIQUETAS, 255)
+    cols, filas = REJILLA_ETIQUETAS
+    ancho = (HOJA_ETIQUETAS[0] - 2 * MARGEN_HOJA) // cols
+    alto = (HOJA_ETIQUETAS[1] - 2 * MARGEN_HOJA) // filas
+    draw = ImageDraw.Draw(hoja)
+    for i, registro in enumerate(registros):
+        x = MARGEN_HOJA + (i % cols) * ancho
+        y = MARGEN_HOJA + (i // cols) * alto
+        hoja.paste(etiqueta_qr(registro, base_url, (ancho, alto)), (x, y))
+        draw.rectangle([x, y, x + ancho - 1, y + alto - 1], outline=200)   # guía de corte
+    return hoja
+
+def hojas_etiquetas(registros, base_url, formato, avance):
+    # registros: lista de dicts con id, ID_Maquina y Area
+    por_hoja = REJILLA_ETIQUETAS[0] * REJILLA_ETIQUETAS[1]
+    lotes = [registros[i:i + por_hoja] for i in range(0, len(registros), por_hoja)]
+    pool = pool_etiquetas()
+    hojas = [None] * len(lotes)
+    futuros = {pool.submit(hoja_de_etiquetas, lote, base_url): i for i, lote in enumerate(lotes)}
+    for hechas, futuro in enumerate(as_completed(futuros), 1):
+        hojas[futuros[futuro]] = futuro.result()
+        avance(0.8 * hechas / len(lotes), f"Hoja {hechas} de {len(lotes)}...")
+    avance(0.85, "Codificando...")
+    buf = io.BytesIO()
+    if formato == 'pdf':
+        # En blanco y negro puro el PDF pesa una fracción del de escala de grises
+        hojas = [h.convert("1", dither=Image.Dither.NONE) for h in hojas]
+        hojas[0].save(buf, format="PDF", save_all=True, append_images=hojas[1:], resolution=DPI_ETIQUETAS)
+    else:
+        # Una imagen por hoja dentro de un ZIP; la codificación PNG también va al pool
+        with zipfile.ZipFile(buf, "w") as z:
+            for i, datos in enumerate(pool.map(png_de, hojas), 1):
+                z.writestr(f"Etiquetas_QR_{i:03d}.png", datos)
+    return buf.getvalue()
 
 # --- FRAGMENTS OPTIMIZACIÓN ---
 @st.fragment
@@ -412,15 +2198,7 @@ def formulario_ingreso_frag(coords_dibujadas):
     insert_data = {}
     if coords_dibujadas and n_z:
         try:
-            val_lmin = 0.0
-            try:
-                val_str = str(med_f).replace('I/min', '').strip()
-                if '-' in val_str:
-                    p = val_str.split('-')
-                    val_lmin = (float(p[0]) + float(p[1]))/2
-                else:
-                    val_lmin = float(val_str)
-            except: pass
+            val_lmin = float(referencia_fuga(t_f, cat_f)['l_min_medio'])
             insert_data = {
                 'x1': coords_dibujadas['x1'], 'y1': coords_dibujadas['y1'],
                 'x2': coords_dibujadas['x2'], 'y2': coords_dibujadas['y2'],
@@ -452,6 +2230,192 @@ def botones_accion_frag(idx, r, base_url_qr):
             borrar_fuga_callback(r['id'])
             st.rerun()
 
+# --- EXPORTACIONES EN SEGUNDO PLANO (SONDEO DE AVANCE) ---
+# Se registra con run_every solo mientras hay trabajos pendientes; cuando cambia ese
+# estado (se envía uno o termina el último) se pide un rerun completo para encender o
+# apagar el sondeo.
+def exportes_pesados_frag(df, clave, umbral, grafica, sondeando):
+    cola = cola_trabajos()
+    claves = claves_exportes(clave, umbral)
+    pendientes = False
+    for col, (tipo, (etiqueta, archivo, mime, trabajo_fn)) in zip(st.columns(len(EXPORTES_PESADOS)), EXPORTES_PESADOS.items()):
+        trabajo = cola.consultar(claves[tipo])
+        with col:
+            if trabajo is None or trabajo['estado'] == 'error':
+                if trabajo is not None:
+                    st.error(f"❌ Falló la exportación: {trabajo['error']}")
+                if st.button(f"⚙️ Preparar {etiqueta}", key=f"preparar_{tipo}", use_container_width=True):
+                    cola.enviar(claves[tipo], partial(trabajo_fn, df, clave, umbral, grafica))
+                    pendientes = True
+            elif trabajo['estado'] == 'listo':
+                st.download_button(
+                    label=etiqueta,
+                    data=trabajo['datos'],
+                    file_name=archivo,
+                    mime=mime,
+                    on_click="ignore",
+                    key=f"descargar_{tipo}",
+                    use_container_width=True
+                )
+            else:
+                pendientes = True
+                st.progress(trabajo['progreso'], text=f"{etiqueta}: {trabajo['texto']}")
+
+    m = cola.metricas()
+    st.caption(f"⚙️ Cola: {m['en_cola']} en espera · {m['en_curso']} en curso · {m['hilos']} hilos · "
+               f"espera media {m['espera_media']:.1f} s · duración media {m['duracion_media']:.1f} s "
+               f"(p95 {m['duracion_p95']:.1f} s)")
+    if pendientes != sondeando:
+        st.rerun()
+
+# --- ETIQUETAS QR EN LOTE (SONDEO DE AVANCE) ---
+# Mismo esquema que las exportaciones pesadas: el lote entra a la cola de trabajos y el
+# fragment solo sondea mientras está pendiente.
+FORMATOS_ETIQUETAS = {
+    'pdf': ("📄 PDF", "Etiquetas_QR.pdf", "application/pdf"),
+    'png': ("🖼️ PNG (ZIP)", "Etiquetas_QR.zip", "application/zip"),
+}
+
+def clave_etiquetas(ids, base_url, version, formato):
+    huella = hashlib.sha256(np.asarray(ids, dtype='int64').tobytes()).hexdigest()
+    return ('etiquetas', formato, base_url.rstrip('/'), version, huella)
+
+def etiquetas_lote_frag(df, seleccion, base_url, version, sondeando):
+    formato = st.radio("Formato", list(FORMATOS_ETIQUETAS), format_func=lambda f: FORMATOS_ETIQUETAS[f][0],
+                       horizontal=True, key="formato_etiquetas")
+    etiqueta, archivo, mime = FORMATOS_ETIQUETAS[formato]
+    lote = df.iloc[seleccion[:MAX_ETIQUETAS_LOTE]]
+    if len(seleccion) > MAX_ETIQUETAS_LOTE:
+        st.warning(f"⚠️ Se imprimen las {MAX_ETIQUETAS_LOTE} más recientes de {len(seleccion)}; afina los filtros para el resto.")
+    cola = cola_trabajos()
+    clave = clave_etiquetas(lote['id'].to_numpy(dtype='int64'), base_url, version, formato)
+    trabajo = cola.consultar(clave)
+    pendientes = False
+    if trabajo is None or trabajo['estado'] == 'error':
+        if trabajo is not None:
+            st.error(f"❌ Falló la generación: {trabajo['error']}")
+        if st.button(f"⚙️ Preparar {len(lote)} etiquetas", key="preparar_etiquetas", use_container_width=True):
+            registros = lote[['id', 'ID_Maquina', 'Area']].to_dict('records')
+            cola.enviar(clave, partial(hojas_etiquetas, registros, base_url, formato))
+            pendientes = True
+    elif trabajo['estado'] == 'listo':
+        st.download_button(
+            label=f"💾 Descargar {len(lote)} etiquetas ({etiqueta})",
+            data=trabajo['datos'],
+            file_name=archivo,
+            mime=mime,
+            on_click="ignore",
+            key="descargar_etiquetas",
+            use_container_width=True
+        )
+    else:
+        pendientes = True
+        st.progress(trabajo['progreso'], text=trabajo['texto'])
+    if pendientes != sondeando:
+        st.rerun()
+
+# --- HISTORIAL PAGINADO ---
+# La parrilla muestra una página fija de tarjetas, de la más reciente a la más antigua.
+# El orden se calcula una vez por versión y los filtros son máscaras sobre él, así que
+# el costo de cada ejecución depende del tamaño de página y no del total de fugas.
+# Filtros y navegación viven en un fragment: solo se vuelve a ejecutar la parrilla.
+TAM_PAGINA_HISTORIAL = 12  # Múltiplo de 3 (columnas de la parrilla)
+
+def orden_recientes(df):
+    # Posiciones de las filas de la más reciente (id mayor) a la más antigua
+    ids = df['id'].to_numpy(dtype='float64', na_value=-1)
+    return np.argsort(-ids, kind='stable')
+
+def mover_pagina(delta):
+    st.session_state.pagina_historial = max(0, st.session_state.get('pagina_historial', 0) + delta)
+
+@st.fragment
+def historial_frag(df, version, base_url_qr):
+    # --- FILTROS LOCALES PARA GESTIÓN ---
+    filtros = almacen.derivado("filtros", version, df, FiltrosDataset)
+    col_f1, col_f2, col_f3 = st.columns([2, 1, 1])
+    with col_f1:
+        search_query = st.text_input("🔍 Buscar en Historial (ID, Zona, Máquina...)", placeholder="Escribe para filtrar...")
+    with col_f2:
+        filtro_area_gest = st.multiselect("Filtrar Área", filtros.opciones.get('Area', []), key="f_area_gest")
+    with col_f3:
+        filtro_estado_gest = st.multiselect("Filtrar Estado", filtros.opciones.get('Estado', []), key="f_estado_gest")
+
+    # Aplicamos filtros locales como máscara (la búsqueda usa el índice de la versión actual)
+    mascara = np.ones(len(df), dtype=bool)
+    if search_query:
+        posiciones = almacen.derivado("busqueda", version, df, IndiceBusqueda).buscar(search_query)
+        if posiciones is not None:
+            mascara[:] = False
+            mascara[posiciones] = True
+    if filtro_area_gest:
+        mascara &= filtros.mascara(Area=filtro_area_gest)
+    if filtro_estado_gest:
+        mascara &= filtros.mascara(Estado=filtro_estado_gest)
+
+    orden = almacen.derivado("orden_historial", version, df, orden_recientes)
+    seleccion = orden[mascara[orden]]
+    total = len(seleccion)
+    if not total:
+        st.info("No se encontraron registros con los filtros actuales.")
+        return
+
+    # Con filtros nuevos se vuelve a la primera página; con datos nuevos solo se acota
+    firma = (search_query, tuple(filtro_area_gest), tuple(filtro_estado_gest))
+    if st.session_state.get('firma_historial') != firma:
+        st.session_state.firma_historial = firma
+        st.session_state.pagina_historial = 0
+    n_paginas = math.ceil(total / TAM_PAGINA_HISTORIAL)
+    pagina = min(st.session_state.get('pagina_historial', 0), n_paginas - 1)
+    st.session_state.pagina_historial = pagina
+    desde = pagina * TAM_PAGINA_HISTORIAL
+    df_pagina = df.iloc[seleccion[desde:desde + TAM_PAGINA_HISTORIAL]]
+    st.caption(f"ℹ️ Mostrando {desde + 1}-{desde + len(df_pagina)} de {total} registros (más recientes primero).")
+
+    # --- ETIQUETAS QR EN LOTE (todas las fugas filtradas) ---
+    with st.expander(f"🖨️ Etiquetas QR en lote ({total} registros filtrados)"):
+        ids_lote = df['id'].to_numpy(dtype='int64')[seleccion[:MAX_ETIQUETAS_LOTE]]
+        sondear = any(cola_trabajos().pendiente(clave_etiquetas(ids_lote, base_url_qr, version, f))
+                      for f in FORMATOS_ETIQUETAS)
+        st.fragment(etiquetas_lote_frag, run_every=INTERVALO_SONDEO if sondear else None)(
+            df, seleccion, base_url_qr, version, sondear)
+
+    # --- RENDERIZADO EN GRID (Parrilla) ---
+    # Usamos st.columns(3) dentro del bucle
+    cols = st.columns(3)
+    for i, (idx, r) in enumerate(df_pagina.iterrows()):
+        with cols[i % 3]: # Distribución cíclica en 3 columnas
+            # Definimos color/borde según estado
+            border_color = "#28a745" if r['Estado'] == "Completada" or r['TipoFuga'] == "Inspección (OK)" else "#d9534f" if r['Estado'] == "Dañada" else "#f0ad4e"
+
+            with st.container(border=True):
+                # Header de la tarjeta
+                c_head1, c_head2 = st.columns([3,1])
+                with c_head1: st.markdown(f"**{r['Zona']}**")
+                with c_head2: st.markdown(f"<span style='color:{border_color}; font-size:1.5em;'>●</span>", unsafe_allow_html=True)
+
+                # Imagen eliminada por solicitud del usuario para limpiar la tarjeta
+
+                st.caption(f"🆔 {r['ID_Maquina']} | 📍 {r['Area']}")
+                st.write(f"**Estado:** {r['Estado']}")
+                
+                if pd.notna(r.get('Comentarios')) and str(r['Comentarios']).strip() != '' and str(r['Comentarios']).lower() != 'nan':
+                    st.info(f"📝 {str(r['Comentarios'])[:80]}..." if len(str(r['Comentarios'])) > 80 else f"📝 {r['Comentarios']}")
+
+                # Botones de Acción
+                botones_accion_frag(idx, r, base_url_qr)
+
+    # --- NAVEGACIÓN ENTRE PÁGINAS ---
+    n1, n2, n3 = st.columns([1, 2, 1])
+    with n1:
+        st.button("⬅️ Anterior", key="hist_anterior", on_click=mover_pagina, args=(-1,),
+                  disabled=pagina == 0, use_container_width=True)
+    with n2:
+        st.markdown(f"<div style='text-align:center;'>Página <b>{pagina + 1}</b> de <b>{n_paginas}</b></div>", unsafe_allow_html=True)
+    with n3:
+        st.button("Siguiente ➡️", key="hist_siguiente", on_click=mover_pagina, args=(1,),
+                  disabled=pagina >= n_paginas - 1, use_container_width=True)
+
 # --- 6. NAVEGACIÓN ---
 def nav_callback(*args, **kwargs):
     # Callback para la selección del menú y evitar recargas completas pesadas
@@ -485,155 +2449,50 @@ if selected_tab == "Mapa":
     # --- MÉTRICAS ACTUALIZADAS ---
     m1, m2, m3, m4, m5 = st.columns(5) # Añadimos m5
 
+    # Todas las métricas salen del cubo de KPIs (rebanado con los filtros actuales)
+    cubo = cubo_kpi(df_filtrado, clave_filtros)
+    completadas = cubo['Estado'] == 'Completada'
+
     with m1:
-        st.metric("Hallazgos Totales", len(df_filtrado))
+        st.metric("Hallazgos Totales", int(cubo['n'].sum()))
 
     with m2:
-        alta_count = len(df_filtrado[df_filtrado['Severidad'] == 'Alta'])
+        alta_count = int(cubo.loc[cubo['Severidad'] == 'Alta', 'n'].sum())
         st.metric("🚨 Prioridad Alta", alta_count)
 
     with m3:
         # IMPACTO TOTAL (General)
-        costo_total = pd.to_numeric(df_filtrado['CostoAnual'], errors='coerce').sum()
+        costo_total = cubo['costo'].sum()
         st.metric("💰 Impacto Total", f"${costo_total:,.0f} USD")
 
     with m4:
         # NUEVA MÉTRICA: AHORRO GENERADO (Solo 'Completada')
-        df_completadas = df_filtrado[df_filtrado['Estado'] == 'Completada']
-        ahorro_real = pd.to_numeric(df_completadas['CostoAnual'], errors='coerce').sum()
+        ahorro_real = cubo.loc[completadas, 'costo'].sum()
         st.metric("✅ Ahorro Generado", f"${ahorro_real:,.0f} USD", delta="¡Buen trabajo!", delta_color="normal")
 
     with m5:
         # IMPACTO PENDIENTE (Dañadas + En proceso)
-        df_pendientes = df_filtrado[df_filtrado['Estado'] != 'Completada']
-        costo_pendiente = pd.to_numeric(df_pendientes['CostoAnual'], errors='coerce').sum()
-        st.metric("⏳ Por Mitigar", f"${costo_pendiente:,.0f} USD", delta=f"-{len(df_pendientes)} fugas", delta_color="inverse")
+        costo_pendiente = cubo.loc[~completadas, 'costo'].sum()
+        n_pendientes = int(cubo.loc[~completadas, 'n'].sum())
+        st.metric("⏳ Por Mitigar", f"${costo_pendiente:,.0f} USD", delta=f"-{n_pendientes} fugas", delta_color="inverse")
 
     st.markdown("---")
 
 
 
     # --- 2. INYECCIÓN DE CSS PARA ANIMACIÓN (Brinco/Pulso) ---
-    # Esto hace que los iconos con la clase 'brinca-peppo' tengan movimiento
-    marker_style = """
-    <style>
-    @keyframes bounce {
-        0%, 20%, 50%, 80%, 100% {transform: translateY(0);}
-        40% {transform: translateY(-10px);}
-        60% {transform: translateY(-5px);}
-    }
-    .brinca-peppo {
-        animation: bounce 2s infinite;
-    }
-    </style>
-    """
-    st.markdown(marker_style, unsafe_allow_html=True)
-
-    # --- 3. CONFIGURACIÓN DEL MAPA (Zoom Libre) ---
-    m = folium.Map(
-        location=[alto_real / 2, ancho_real / 2],
-        zoom_start=-1, # Inicio con vista general
-        crs="Simple",
-        min_zoom=-2,   # Permite alejar para ver todo el plano
-        max_zoom=4     # Permite mucho acercamiento
-    )
-
-
-    m.get_root().header.add_child(folium.Element(marker_style))
-
-    ImageOverlay(
-        image="PlanoHanon.webp",
-        bounds=[[0, 0], [alto_real, ancho_real]],
-        opacity=0.8
-    ).add_to(m)
-
-    # --- NUEVO: CAPA DE ZONAS INSPECCIONADAS (Tab 1) ---
-    # Renderizamos rectángulos verdes para las zonas marcadas como "Inspección (OK)"
-    inspecciones = df_filtrado[df_filtrado['TipoFuga'] == "Inspección (OK)"]
-    if not inspecciones.empty:
-        for _, row_ins in inspecciones.iterrows():
-            factor_x = ancho_real / 1200
-            factor_y = alto_real / (1200 * (alto_real / ancho_real))
-
-            p1_map = [alto_real - (row_ins['y2'] * factor_y), row_ins['x1'] * factor_x]
-            p2_map = [alto_real - (row_ins['y1'] * factor_y), row_ins['x2'] * factor_x]
-
-            folium.Rectangle(
-                bounds=[p1_map, p2_map],
-                color="#28A745",
-                weight=1,
-                fill=True,
-                fill_opacity=0.2, # Baja opacidad para no tapar mucho
-                tooltip=f"Zona Inspeccionada: {row_ins['Area']}"
-            ).add_to(m)
-
-# --- 4. RENDERIZADO DE MARCADORES ---
-    for i, row in df_filtrado.iterrows():
-        factor_x, factor_y = ancho_real / 1200, alto_real / (1200 * (alto_real / ancho_real))
-        cx, cy = (row['x1'] + row['x2']) / 2 * factor_x, alto_real - ((row['y1'] + row['y2']) / 2 * factor_y)
-
-        f_info = FLUIDOS.get(row['TipoFuga'], {"color": "white", "marker": "red", "emoji": "⚠️"})
-        color_sev = {"Alta": "#FF4B4B", "Media": "#FFA500", "Baja": "#28A745"}.get(row['Severidad'], "#333")
-
-
-        # --- LÓGICA DE UBICACIÓN ---
-        ubi = row.get('Ubicacion', 'Terrestre') # 'Ubicacion' debe ser el nombre de tu columna en GSheets
-        ubi_emoji = "🚜" if ubi == "Terrestre" else "☁️"
-
-        # Tooltip Elegante (Actualizado con Ubicación)
-        hover_html = f"""
-        <div style="background-color:#1d2129; color:white; padding:10px; border-radius:8px; border-left:5px solid {f_info['color']}; min-width:150px;">
-            <b>{f_info['emoji']} {row['Area']}</b><br>
-            <span style="color:#bdc3c7; font-size:0.85em;">{ubi_emoji} Instalación: {ubi}</span><br>
-            <span style="color:{color_sev}; font-size:0.9em;">Severidad: {row['Severidad']}</span><br>
-            <span style="color:#bdc3c7; font-size:0.85em;"><i>{str(row.get('Comentarios', ''))[:50] + '...' if len(str(row.get('Comentarios', ''))) > 50 else str(row.get('Comentarios', ''))}</i></span>
-        </div>"""
-
-# Popup (Clic) - Cambiamos "Zona" por "Área de Planta"
-        # Popup (Clic) - Cambiamos "Zona" por "Área de Planta" y añadimos ID MAQUINA
-        popup_content = f"""
-        <div style="font-family: 'Segoe UI', sans-serif; color: #333; min-width: 250px;">
-            <h4 style="margin:0 0 10px 0; color:{f_info['color']}; border-bottom: 2px solid {color_sev};">📋 Ficha Técnica</h4>
-            <table style="width:100%; font-size: 13px; border-spacing: 0 5px;">
-                <tr><td><b>ID Máquina:</b></td><td><b>{row.get('ID_Maquina', 'N/A')}</b></td></tr>
-                <tr><td><b>Área de Planta:</b></td><td>{row['Area']}</td></tr>
-                <tr><td><b>Instalación:</b></td><td>{ubi_emoji} {ubi}</td></tr>
-                <tr><td><b>Estado:</b></td><td><b>{row.get('Estado', 'N/A')}</b></td></tr>
-                <tr><td><b>Categoria:</b></td><td>{row.get('Categoria', 'N/A')}</td></tr>
-                <tr><td><b>Caudal:</b></td><td>{row.get('L_min', 'N/A')} I/min</td></tr>
-                <tr><td><b>Costo/Año:</b></td><td style="color:#d9534f; font-weight:bold;">${row.get('CostoAnual', '0')} USD</td></tr>
-                <tr><td><b>Severidad:</b></td><td style="color:{color_sev}; font-weight:bold;">{row['Severidad']}</td></tr>
-                <tr><td><b>Fechas:</b></td><td>{row['Zona']}</td></tr>
-                <tr><td colspan="2" style="border-top:1px solid #ddd; padding-top:5px;"><b>Comentarios:</b><br/>{row.get('Comentarios', '')}</td></tr>
-            </table>
-        </div>
-        """
-
-        # Crear el Icono
-        # Si es Severidad Alta, le añadimos la clase 'brinca-peppo' para que salte
-        clase_css = "brinca-peppo" if row['Severidad'] == "Alta" else ""
-
-        # --- ICONOGRAFÍA DINÁMICA ---
-        # Por defecto info-sign. Si está completada o es inspección OK, usamos ok-sign (check)
-        icono_mapa = "info-sign"
-        if row['Estado'] == "Completada" or row['TipoFuga'] == "Inspección (OK)":
-            icono_mapa = "ok-sign" # Check verde
-
-        # Si es Inspección (OK), no queremos marcador, o sí?
-        # El user pide "Zonas Inspeccionadas" como rectángulos (ya hecho arriba),
-        # pero si está en el grid, quizás quiera ver el punto central también.
-        # "Visualización: En el mapa de gestión (Tab 2), las zonas inspeccionadas deben renderizarse con un rectángulo verde sólido" -> Esto es para Tab 2 (Config/mapa 2), pero el user dijo "Tab 2...".
-        # Espera, punto 3 dice "Tab 'Mapa' ... Implementa la capa de 'Zonas Inspeccionadas' en el Tab 1".
-        # Asumimos que también se dibujan marcadores normales para mantener consistencia, solo que verdes.
-
-        folium.Marker(
-            location=[cy, cx],
-            popup=folium.Popup(popup_content, max_width=350),
-            tooltip=folium.Tooltip(hover_html),
-            icon=folium.Icon(color=f_info['marker'], icon=icono_mapa, extra_params=f'class="{clase_css}"')
-        ).add_to(m)
-
-    st_folium(m, width=1400, height=750, use_container_width=True, returned_objects=[])
+    st.markdown(ESTILO_MARCADORES, unsafe_allow_html=True)
+
+    # --- 3. MAPA (desde la caché si los datos y filtros no cambiaron) ---
+    if vista_dinamica:
+        # Mapa base fijo + capa de la vista actual (bounds de la interacción anterior)
+        caja = caja_vista(st.session_state.get("mapa_vivo"))
+        capa = capa_vista(fugas_visibles(df_filtrado, caja), clave_filtros + ('vista', caja), umbral_cluster)
+        st_folium(mapa_base(), width=1400, height=750, use_container_width=True, key="mapa_vivo",
+                  returned_objects=["bounds", "zoom"], feature_group_to_add=capa)
+    else:
+        m = mapa_fugas(df_filtrado, clave_filtros, 'vivo', umbral_cluster)
+        st_folium(m, width=1400, height=750, use_container_width=True, returned_objects=[])
 
 
 
@@ -651,47 +2510,17 @@ elif selected_tab == "Gestión":
     st.info("Basándote en el plano de arriba, dibuja el área de la fuga aquí:")
 
     # --- CONFIGURACIÓN DEL MAPA DINÁMICO (Draw) ---
-    m2 = folium.Map(
-        location=[alto_real / 2, ancho_real / 2],
-        zoom_start=-1,
-        crs="Simple",
-        min_zoom=-2,
-        max_zoom=4
-    )
-
-    ImageOverlay(
-        image="PlanoHanon.webp",
-        bounds=[[0, 0], [alto_real, ancho_real]],
-        opacity=1
-    ).add_to(m2)
+    m2 = mapa_base(opacidad=1)
 
     # --- INICIO: CAPA DE MEMORIA (Zonas ya registradas) ---
     # Dibujamos lo que ya existe en el DataFrame para no encimar registros
-    if not st.session_state.dfZonas.empty:
-        for i, row in st.session_state.dfZonas.iterrows():
-            try:
-                # Revertimos la escala de 1200px a la escala real del plano
-                factor_x = ancho_real / 1200
-                factor_y = alto_real / (1200 * (alto_real / ancho_real))
-
-                # Coordenadas Folium (Invertidas en Y)
-                # p1: Top-Left, p2: Bottom-Right
-                p1_map = [alto_real - (row['y1'] * factor_y), row['x1'] * factor_x]
-                p2_map = [alto_real - (row['y2'] * factor_y), row['x2'] * factor_x]
-
-                # Usamos el color del fluido para identificar la zona
-                f_color = FLUIDOS.get(row['TipoFuga'], {"color": "gray"})['color']
-
-                folium.Rectangle(
-                    bounds=[p1_map, p2_map],
-                    color=f_color,
-                    weight=2,
-                    fill=True,
-                    fill_opacity=0.3,
-                    tooltip=f"Ya registrado: {row['Area']} ({row['TipoFuga']})"
-                ).add_to(m2)
-            except:
-                continue
+    # (con la vista dinámica, solo lo que cae en la vista actual)
+    caja_memoria = caja_vista(st.session_state.get("draw_map")) if vista_dinamica else None
+    def construir_memoria():
+        zonas = json_seguro(zonas_de(fugas_visibles(st.session_state.dfZonas, caja_memoria), "Ya registrado: {area} ({tipo})"))
+        return zonas, len(zonas)
+    capa_memoria = folium.FeatureGroup(name="Zonas registradas")
+    CapaZonas(cache_mapas().obtener(('memoria', version_datos, caja_memoria), construir_memoria)).add_to(capa_memoria)
     # --- FIN: CAPA DE MEMORIA ---
 
     # Configuración de herramientas de dibujo
@@ -712,7 +2541,8 @@ elif selected_tab == "Gestión":
 
     # Capturamos la salida del mapa con dibujo
     # Nota: mantenemos el key original "draw_map"
-    output = st_folium(m2, width=1200, height=600, key="draw_map", returned_objects=["all_drawings"])
+    output = st_folium(m2, width=1200, height=600, key="draw_map",
+                       returned_objects=["all_drawings", "bounds", "zoom"], feature_group_to_add=capa_memoria)
 
     coords_dibujadas = None
     if output["all_drawings"]:
@@ -744,109 +2574,65 @@ elif selected_tab == "Gestión":
             }
             st.success(f"Zona capturada: ({int(x1_stored)}, {int(y1_stored)}) - ({int(x2_stored)}, {int(y2_stored)})")
 
+            # Comprobación de encimado contra las zonas ya registradas
+            choques = indice_fugas.consultar((x1_stored, y1_stored, x2_stored, y2_stored))
+            if choques:
+                df_choques = st.session_state.dfZonas[st.session_state.dfZonas['id'].isin(choques)]
+                detalle = ", ".join(f"#{i} ({a})" for i, a in zip(df_choques['id'], df_choques['Area']))
+                st.warning(f"⚠️ La zona se encima con {len(choques)} registro(s) existente(s): {detalle}")
+
     st.markdown("---")
     formulario_ingreso_frag(coords_dibujadas)
 
     st.subheader("📋 Historial de Gestión")
 
-    # --- FILTROS LOCALES PARA GESTIÓN ---
-    col_f1, col_f2, col_f3 = st.columns([2, 1, 1])
-    with col_f1:
-        search_query = st.text_input("🔍 Buscar en Historial (ID, Zona, Máquina...)", placeholder="Escribe para filtrar...")
-    with col_f2:
-        filtro_area_gest = st.multiselect("Filtrar Área", sorted(st.session_state.dfZonas['Area'].unique()), key="f_area_gest")
-    with col_f3:
-        filtro_estado_gest = st.multiselect("Filtrar Estado", sorted(st.session_state.dfZonas['Estado'].unique()), key="f_estado_gest")
-
-    # Aplicamos filtros locales
-    df_gestion = st.session_state.dfZonas.copy()
-    if search_query:
-        df_gestion = df_gestion[
-            df_gestion.apply(lambda row: search_query.lower() in str(row.values).lower(), axis=1)
-        ]
-    if filtro_area_gest:
-        df_gestion = df_gestion[df_gestion['Area'].isin(filtro_area_gest)]
-    if filtro_estado_gest:
-        df_gestion = df_gestion[df_gestion['Estado'].isin(filtro_estado_gest)]
-
-    # --- OPTIMIZACIÓN: RENDERIZADO AL 50% SI NO HAY FILTROS ---
-    # "Solo renderizamos la mitad y la otra mitad a través del filtro"
-    if not search_query and not filtro_area_gest and not filtro_estado_gest:
-        limit_regs = int(len(df_gestion) / 2)
-        if limit_regs > 0:
-            # Mostramos los MÁS RECIENTES (tail)
-            df_gestion = df_gestion.tail(limit_regs)
-            st.caption(f"ℹ️ Mostrando los {limit_regs} registros más recientes. Usa los filtros para ver más antiguos.")
-
-    # --- RENDERIZADO EN GRID (Parrilla) ---
-    # Usamos st.columns(3) dentro del bucle
-    if not df_gestion.empty:
-        cols = st.columns(3)
-        for i, (idx, r) in enumerate(df_gestion.iterrows()):
-            with cols[i % 3]: # Distribución cíclica en 3 columnas
-                # Definimos color/borde según estado
-                border_color = "#28a745" if r['Estado'] == "Completada" or r['TipoFuga'] == "Inspección (OK)" else "#d9534f" if r['Estado'] == "Dañada" else "#f0ad4e"
-
-                with st.container(border=True):
-                    # Header de la tarjeta
-                    c_head1, c_head2 = st.columns([3,1])
-                    with c_head1: st.markdown(f"**{r['Zona']}**")
-                    with c_head2: st.markdown(f"<span style='color:{border_color}; font-size:1.5em;'>●</span>", unsafe_allow_html=True)
-
-                    # Imagen eliminada por solicitud del usuario para limpiar la tarjeta
-
-                    st.caption(f"🆔 {r['ID_Maquina']} | 📍 {r['Area']}")
-                    st.write(f"**Estado:** {r['Estado']}")
-                    
-                    if r.get('Comentarios') and str(r['Comentarios']).strip() != '' and str(r['Comentarios']).lower() != 'nan':
-                        st.info(f"📝 {str(r['Comentarios'])[:80]}..." if len(str(r['Comentarios'])) > 80 else f"📝 {r['Comentarios']}")
-
-                    # Botones de Acción
-                    botones_accion_frag(idx, r, base_url_qr)
-    else:
-        st.info("No se encontraron registros con los filtros actuales.")
+    historial_frag(st.session_state.dfZonas, version_datos, base_url_qr)
 
 elif selected_tab == "Reporte":
     st.subheader("📊 Panel de Control Operativo")
 
     # --- TODO DENTRO DE ESTE IF ---
     if not df_filtrado.empty:
-        # 1. PREPARACIÓN DE DATOS
-        df_filtrado['CostoAnual'] = pd.to_numeric(df_filtrado['CostoAnual'], errors='coerce').fillna(0)
-
-        df_reparacion = df_filtrado.copy()
-        df_reparacion['Eficiencia'] = df_reparacion['Estado'].apply(
-            lambda x: 'Reparada' if x == 'Completada' else 'Pendiente'
-        )
-        total = len(df_reparacion)
-        reparadas = len(df_reparacion[df_reparacion['Eficiencia'] == 'Reparada'])
+        # 1. PREPARACIÓN DE DATOS: rebanadas del cubo de KPIs (agregado en el servidor si se puede)
+        cubo = cubo_reporte(df_filtrado, clave_filtros)
+        total = int(cubo['n'].sum())
+        reparadas = int(cubo.loc[cubo['Estado'] == 'Completada', 'n'].sum())
         porcentaje = (reparadas / total * 100) if total > 0 else 0
 
+        # Un solo dataset con nombre, compartido por G1-G4 y declarado una vez al nivel
+        # superior del spec: una fila por grupo y solo las columnas que usan las gráficas,
+        # así el tamaño del spec (y del HTML exportado) no depende del número de fugas.
+        datos_graficas = suma_por(cubo, ['TipoFuga', 'Estado', 'Severidad', 'Categoria'], ['n', 'costo'])
+        datasets_reporte = {"resumen_reporte": json.loads(datos_graficas.to_json(orient='records', force_ascii=False))}
+        fuente = alt.NamedData(name="resumen_reporte")
+
         # 2. DEFINICIÓN DE GRÁFICAS (G1, G2, G3, G4, G5)
-        g1 = alt.Chart(df_filtrado).mark_bar().encode(
+        g1 = alt.Chart(fuente).mark_bar().encode(
             x=alt.X('Severidad:N', sort=['Baja', 'Media', 'Alta'], title="Nivel de Severidad"),
-            y=alt.Y('count():Q', title="Cantidad de Hallazgos"),
+            y=alt.Y('sum(n):Q', title="Cantidad de Hallazgos"),
             color=alt.Color('TipoFuga:N', scale=alt.Scale(domain=list(FLUIDOS.keys()),
                                                          range=[f['color'] for f in FLUIDOS.values()]), legend=None),
-            tooltip=['TipoFuga', 'count()']
+            tooltip=['TipoFuga:N', alt.Tooltip('sum(n):Q', title='Hallazgos')]
         ).properties(width=180, height=250, title="Distribución por Severidad")
 
-        g2 = alt.Chart(df_filtrado).mark_bar().encode(
+        g2 = alt.Chart(fuente).mark_bar().encode(
             y=alt.Y('Estado:N', sort='-x', title=None),
-            x=alt.X('count():Q', title="Fugas"),
+            x=alt.X('sum(n):Q', title="Fugas"),
             color=alt.Color('Estado:N', scale=alt.Scale(domain=['Dañada', 'En proceso de reparar', 'Completada'],
                                                        range=['#d9534f', '#f0ad4e', '#5cb85c']), legend=None),
-            tooltip=['Estado', 'count()']
+            tooltip=['Estado:N', alt.Tooltip('sum(n):Q', title='Fugas')]
         ).properties(width=180, height=250, title="Estatus")
 
-        g3 = alt.Chart(df_filtrado).mark_bar(color="#d9534f").encode(
+        g3 = alt.Chart(fuente).mark_bar(color="#d9534f").encode(
             x=alt.X('Categoria:N', title="Cat"),
-            y=alt.Y('sum(CostoAnual):Q', title="USD"),
-            tooltip=['Categoria', 'sum(CostoAnual)']
+            y=alt.Y('sum(costo):Q', title="USD"),
+            tooltip=['Categoria:N', alt.Tooltip('sum(costo):Q', title='USD', format=',.0f')]
         ).properties(width=180, height=250, title="Impacto ($)")
 
-        base_anillo = alt.Chart(df_reparacion).encode(
-            theta=alt.Theta("Eficiencia:N", aggregate="count"),
+        base_anillo = alt.Chart(fuente).transform_calculate(
+            Eficiencia="datum.Estado === 'Completada' ? 'Reparada' : 'Pendiente'"
+        ).encode(
+            theta=alt.Theta("sum(n):Q"),
             color=alt.Color("Eficiencia:N", scale=alt.Scale(domain=['Reparada', 'Pendiente'],
                                                            range=['#5cb85c', '#d9534f']), legend=None)
         )
@@ -855,8 +2641,9 @@ elif selected_tab == "Reporte":
         g4 = (anillo + texto).properties(width=180, height=250, title="Eficiencia")
 
         # --- CORRECCIÓN G5: COBERTURA (Anillo con % Central y Colores Dinámicos) ---
-        n_inspecciones = len(df_filtrado[df_filtrado['TipoFuga'] == "Inspección (OK)"])
-        n_fugas_activas = len(df_filtrado[df_filtrado['Estado'].isin(['Dañada', 'En proceso de reparar'])])
+        es_inspeccion = cubo['TipoFuga'] == "Inspección (OK)"
+        n_inspecciones = int(cubo.loc[es_inspeccion, 'n'].sum())
+        n_fugas_activas = int(cubo.loc[cubo['Estado'].isin(['Dañada', 'En proceso de reparar']), 'n'].sum())
         total_cobertura = n_inspecciones + n_fugas_activas
         pct_cobertura = (n_inspecciones / total_cobertura * 100) if total_cobertura > 0 else 0
 
@@ -879,9 +2666,10 @@ elif selected_tab == "Reporte":
             "Sin Fuga (Aceite)": FLUIDOS.get("Aceite", {}).get("color", "#FFFF00")
         }
 
-        df_inspecciones = df_filtrado[df_filtrado['TipoFuga'] == "Inspección (OK)"]
-        if not df_inspecciones.empty:
-            for cat, count in df_inspecciones['Categoria'].value_counts().items():
+        # Como el value_counts() original: las inspecciones sin categoría no van a la dona
+        inspecciones_cat = suma_por(cubo[es_inspeccion], ['Categoria'], dropna=True).sort_values('n', ascending=False, kind='stable')
+        if not inspecciones_cat.empty:
+            for cat, count in zip(inspecciones_cat['Categoria'], inspecciones_cat['n']):
                 if count > 0:
                     categorias_pie.append(str(cat))
                     valores_pie.append(count)
@@ -912,242 +2700,55 @@ elif selected_tab == "Reporte":
         g5 = (anillo_g5 + texto_g5).properties(width=180, height=250, title="Cobertura vs Fugas")
 
         # 3. RENDERIZADO DASHBOARD
-        dashboard_unificado = alt.hconcat(g1, g2, g3, g4, g5).configure_view(stroke=None).configure_concat(spacing=30)
+        dashboard_unificado = alt.hconcat(g1, g2, g3, g4, g5, datasets=datasets_reporte).configure_view(stroke=None).configure_concat(spacing=30)
         st.altair_chart(dashboard_unificado, use_container_width=True)
 
         # 4. PLANO DE RIESGOS (BAJADO)
         st.markdown("---")
         st.markdown("#### 🗺️ Ubicación Física de Hallazgos")
-        rep_img = img_original.copy()
-        draw = ImageDraw.Draw(rep_img)
-        sc = ancho_real / 1200
-        for _, r in df_filtrado.iterrows():
-            color_hex = FLUIDOS.get(r['TipoFuga'], {"color": "#FFFFFF"})['color']
-            co = [r['x1']*sc, r['y1']*sc, r['x2']*sc, r['y2']*sc]
-            draw.rectangle(co, outline=color_hex, width=25)
-
+        # Capa de rectángulos en caché, actualizada solo donde cambian las fugas
+        rep_img = plano_riesgos(df_filtrado, clave_filtros, ANCHO_VISTA_REPORTE)
         st.image(rep_img, caption="Vista de Riesgos en Planta", use_container_width=True)
 
 # 5. BOTONES DE DESCARGA (CENTRADO Y ESTILIZADO)
         st.subheader("📥 Exportar Reportes")
 
-        # Creamos 5 columnas para usar las de los extremos como "aire" y centrar los 3 botones principales
-        _, d_col1, d_col2, d_col3, _ = st.columns([0.5, 3, 3, 3, 0.5])
+        # Columnas de los extremos como "aire": datos a la izquierda, exportaciones pesadas a la derecha
+        _, d_col1, d_col2, _ = st.columns([0.5, 3, 9, 0.5])
 
         with d_col1:
-            # --- EXPORTACIÓN CSV (Saneado) ---
-            df_export = df_filtrado.copy()
-
-            # 1) Quitar datos de coordenadas
-            df_export = df_export.drop(columns=['x1', 'y1', 'x2', 'y2'], errors='ignore')
-
-            # 2) Renombrar columna 'Zona' a 'Fechas'
-            df_export = df_export.rename(columns={'Zona': 'Fechas'})
-
-            # 3) Procesar L_min como datos numéricos
-            def limpiar_l_min(valor):
-                try:
-                    v_str = str(valor).replace('I/min', '').strip()
-                    if '-' in v_str:
-                        return float(v_str.split('-')[-1])
-                    return float(v_str)
-                except:
-                    return 0.0
-
-            df_export['L_min'] = df_export['L_min'].apply(limpiar_l_min)
-
-            csv = df_export.to_csv(index=False).encode('utf-8')
-            st.download_button(
-                label="📊 Datos (CSV)",
-                data=csv,
-                file_name="Reporte_Fugas.csv",
-                mime="text/csv",
-                use_container_width=True
-            )
-
-        with d_col2:
-            # --- REPORTE GRÁFICO PROFESIONAL (HTML CUSTOM) ---
-            # Extraemos el JSON de la gráfica unificada
-            import json
-            chart_json = dashboard_unificado.to_json()
-
-            # Plantilla HTML con estilos profesionales (Dark Theme & Glassmorphism)
-            profesional_html = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-              <title>Leak Hunter | Executive Report</title>
-              <script src="https://cdn.jsdelivr.net/npm/vega@5"></script>
-              <script src="https://cdn.jsdelivr.net/npm/vega-lite@5"></script>
-              <script src="https://cdn.jsdelivr.net/npm/vega-embed@6"></script>
-              <style>
-                body {{
-                  background-color: #0e1117;
-                  color: #fafafa;
-                  font-family: 'Segoe UI', Roboto, Helvetica, Arial, sans-serif;
-                  display: flex;
-                  flex-direction: column;
-                  align-items: center;
-                  padding: 40px;
-                  margin: 0;
-                }}
-                .container {{
-                  max-width: 1200px;
-                  width: 100%;
-                }}
-                .header {{
-                  text-align: center;
-                  padding: 30px;
-                  background: linear-gradient(135deg, #161a22 0%, #1d2129 100%);
-                  border-radius: 20px;
-                  border: 1px solid #2d323d;
-                  margin-bottom: 30px;
-                  box-shadow: 0 10px 30px rgba(0,0,0,0.5);
-                }}
-                .header h1 {{ margin: 0; color: #5271ff; font-size: 2.5em; letter-spacing: -1px; }}
-                .header p {{ color: #888; margin-top: 10px; font-size: 1.1em; }}
-                #vis {{
-                  background: #161a22;
-                  padding: 30px;
-                  border-radius: 20px;
-                  border: 1px solid #2d323d;
-                  box-shadow: 0 10px 30px rgba(0,0,0,0.5);
-                  overflow-x: auto;
-                }}
-                .footer {{
-                  margin-top: 50px;
-                  text-align: center;
-                  color: #444;
-                  font-size: 0.9em;
-                  border-top: 1px solid #2d323d;
-                  padding-top: 20px;
-                  width: 100%;
-                }}
-              </style>
-            </head>
-            <body>
-              <div class="container">
-                <div class="header">
-                  <h1>🏭 Leak Hunter Report</h1>
-                  <p>Monitoring Dashboard | Industrial Digital Twin Report</p>
-                </div>
-                <div id="vis"></div>
-                <div class="footer">
-                  Developed by Master Engineer Erik Armenta &copy; 2026
-                </div>
-              </div>
-              <script>
-                const spec = {chart_json};
-                vegaEmbed('#vis', spec, {{
-                  mode: "vega-lite",
-                  theme: "dark",
-                  actions: true
-                }}).then(console.log).catch(console.warn);
-              </script>
-            </body>
-            </html>
-            """
-
+            # --- EXPORTACIÓN DE DATOS (Saneado, se genera al hacer clic) ---
+            etiqueta, archivo, mime = FORMATOS_DATOS['csv']
             st.download_button(
-                label="📈 Leak Hunter | Executive Report",
-                data=profesional_html,
-                file_name="Dashboard_Interactivo_LeakHunter.html",
-                mime="text/html",
+                label=etiqueta,
+                data=partial(exportar_datos, df_filtrado, clave_filtros, 'csv'),
+                file_name=archivo,
+                mime=mime,
+                on_click="ignore",
                 use_container_width=True
             )
-
-        with d_col3:
-            # --- MAPA INTERACTIVO (HTML) ---
-            # Crear mapa folium independiente para exportación
-            m_export = folium.Map(
-                location=[alto_real / 2, ancho_real / 2],
-                zoom_start=-1,
-                crs="Simple",
-                min_zoom=-2,
-                max_zoom=4
-            )
-            
-            # CSS for Animations in the interactive map export
-            marker_style_export = """
-            <style>
-            @keyframes bounce {
-                0%, 20%, 50%, 80%, 100% {transform: translateY(0);}
-                40% {transform: translateY(-10px);}
-                60% {transform: translateY(-5px);}
-            }
-            .brinca-peppo {
-                animation: bounce 2s infinite;
-            }
-            </style>
-            """
-            m_export.get_root().header.add_child(folium.Element(marker_style_export))
-
-            ImageOverlay(
-                image="PlanoHanon.webp",
-                bounds=[[0, 0], [alto_real, ancho_real]],
-                opacity=0.8
-            ).add_to(m_export)
-
-            # Agregar marcadores al mapa de exportación
-            for _, row in df_filtrado.iterrows():
-                factor_x = ancho_real / 1200
-                factor_y = alto_real / (1200 * (alto_real / ancho_real))
-                cx = (row['x1'] + row['x2']) / 2 * factor_x
-                cy = alto_real - ((row['y1'] + row['y2']) / 2 * factor_y)
-                
-                f_info = FLUIDOS.get(row['TipoFuga'], {"color": "white", "marker": "red", "emoji": "⚠️"})
-                color_sev = {"Alta": "#FF4B4B", "Media": "#FFA500", "Baja": "#28A745"}.get(row['Severidad'], "#333")
-                ubi = row.get('Ubicacion', 'Terrestre')
-                ubi_emoji = "🚜" if ubi == "Terrestre" else "☁️"
-                
-                hover_html_export = f"""
-                <div style="background-color:#1d2129; color:white; padding:10px; border-radius:8px; border-left:5px solid {f_info['color']}; min-width:150px;">
-                    <b>{f_info['emoji']} {row['Area']}</b><br>
-                    <span style="color:#bdc3c7; font-size:0.85em;">{ubi_emoji} Instalación: {ubi}</span><br>
-                    <span style="color:{color_sev}; font-size:0.9em;">Severidad: {row['Severidad']}</span><br>
-                    <span style="color:#bdc3c7; font-size:0.85em;"><i>{str(row.get('Comentarios', ''))[:50] + '...' if len(str(row.get('Comentarios', ''))) > 50 else str(row.get('Comentarios', ''))}</i></span>
-                </div>"""
-
-                popup_content_export = f"""
-                <div style="font-family: 'Segoe UI', sans-serif; color: #333; min-width: 250px;">
-                    <h4 style="margin:0 0 10px 0; color:{f_info['color']}; border-bottom: 2px solid {color_sev};">📋 Ficha Técnica</h4>
-                    <table style="width:100%; font-size: 13px; border-spacing: 0 5px;">
-                        <tr><td><b>ID Máquina:</b></td><td><b>{row.get('ID_Maquina', 'N/A')}</b></td></tr>
-                        <tr><td><b>Área de Planta:</b></td><td>{row['Area']}</td></tr>
-                        <tr><td><b>Instalación:</b></td><td>{ubi_emoji} {ubi}</td></tr>
-                        <tr><td><b>Estado:</b></td><td><b>{row.get('Estado', 'N/A')}</b></td></tr>
-                        <tr><td><b>Categoria:</b></td><td>{row.get('Categoria', 'N/A')}</td></tr>
-                        <tr><td><b>Caudal:</b></td><td>{row.get('L_min', 'N/A')} I/min</td></tr>
-                        <tr><td><b>Costo/Año:</b></td><td style="color:#d9534f; font-weight:bold;">${row.get('CostoAnual', '0')} USD</td></tr>
-                        <tr><td><b>Severidad:</b></td><td style="color:{color_sev}; font-weight:bold;">{row['Severidad']}</td></tr>
-                        <tr><td><b>Fechas:</b></td><td>{row['Zona']}</td></tr>
-                        <tr><td colspan="2" style="border-top:1px solid #ddd; padding-top:5px;"><b>Comentarios:</b><br/>{row.get('Comentarios', '')}</td></tr>
-                    </table>
-                </div>
-                """
-
-                clase_css_export = "brinca-peppo" if row['Severidad'] == "Alta" else ""
-                icono_mapa_export = "info-sign"
-                if row['Estado'] == "Completada" or row['TipoFuga'] == "Inspección (OK)":
-                    icono_mapa_export = "ok-sign"
-
-                folium.Marker(
-                    location=[cy, cx],
-                    popup=folium.Popup(popup_content_export, max_width=350),
-                    tooltip=folium.Tooltip(hover_html_export),
-                    icon=folium.Icon(color=f_info['marker'], icon=icono_mapa_export, extra_params=f'class="{clase_css_export}"')
-                ).add_to(m_export)
-
-            m_export.save("mapa_interactivo.html")
-            with open("mapa_interactivo.html", "rb") as f:
-                st.download_button(
-                    label="🗺️ Plano Interactivo",
-                    data=f,
-                    file_name="Mapa_Interactivo.html",
-                    mime="text/html",
+            # Formatos columnares para extractos grandes
+            for col_formato, formato in zip(st.columns(2), ['parquet', 'xlsx']):
+                etiqueta, archivo, mime = FORMATOS_DATOS[formato]
+                disponible = formato != 'xlsx' or EXCEL_DISPONIBLE
+                col_formato.download_button(
+                    label=etiqueta,
+                    data=partial(exportar_datos, df_filtrado, clave_filtros, formato),
+                    file_name=archivo,
+                    mime=mime,
+                    on_click="ignore",
+                    disabled=not disponible,
+                    help=None if disponible else "Requiere openpyxl (pip install openpyxl)",
                     use_container_width=True
                 )
 
+        with d_col2:
+            # --- PLANO DE RIESGOS, REPORTE HTML Y MAPA INTERACTIVO (COLA DE TRABAJOS) ---
+            claves = claves_exportes(clave_filtros, umbral_cluster).values()
+            sondear = any(cola_trabajos().pendiente(c) for c in claves)
+            st.fragment(exportes_pesados_frag, run_every=INTERVALO_SONDEO if sondear else None)(
+                df_filtrado, clave_filtros, umbral_cluster, dashboard_unificado, sondear)
+
 # --- FOOTER CON FIRMA ---
 st.markdown(f"""<div style="text-align: center; color: #888; background-color: #161a22; padding: 25px; border-radius: 15px; border: 1px solid #2d323d; margin-top: 40px;">
     <h3 style="color: #fff;">🏭💧 Leak Hunter Digital Twin v4.0</h3>
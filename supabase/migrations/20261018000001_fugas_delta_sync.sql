@@ -0,0 +1,54 @@
+-- Sincronización incremental de la tabla fugas
+-- La App guarda una marca de agua (updated_at) y solo pide las filas modificadas;
+-- los borrados se propagan como lápidas en fugas_borradas.
+
+alter table public.fugas
+    add column if not exists updated_at timestamptz not null default now();
+
+create index if not exists fugas_updated_at_idx on public.fugas (updated_at);
+
+create or replace function public.fugas_touch_updated_at()
+returns trigger
+language plpgsql
+as $$
+begin
+    new.updated_at := now();
+    return new;
+end;
+$$;
+
+drop trigger if exists fugas_touch_updated_at on public.fugas;
+create trigger fugas_touch_updated_at
+    before update on public.fugas
+    for each row execute function public.fugas_touch_updated_at();
+
+-- Lápidas: un registro por fuga eliminada
+create table if not exists public.fugas_borradas (
+    id bigint primary key,
+    deleted_at timestamptz not null default now()
+);
+
+create index if not exists fugas_borradas_deleted_at_idx on public.fugas_borradas (deleted_at);
+
+create or replace function public.fugas_registrar_borrado()
+returns trigger
+language plpgsql
+as $$
+begin
+    insert into public.fugas_borradas (id, deleted_at)
+    values (old.id, now())
+    on conflict (id) do update set deleted_at = excluded.deleted_at;
+    return old;
+end;
+$$;
+
+drop trigger if exists fugas_registrar_borrado on public.fugas;
+create trigger fugas_registrar_borrado
+    after delete on public.fugas
+    for each row execute function public.fugas_registrar_borrado();
+
+alter table public.fugas_borradas enable row level security;
+
+drop policy if exists "Lectura de lapidas" on public.fugas_borradas;
+create policy "Lectura de lapidas" on public.fugas_borradas
+    for select using (true);
@@ -0,0 +1,35 @@
+-- Agregación en el servidor para el Reporte
+-- Devuelve conteo y costo por fluido, estado, área, severidad y categoría con los
+-- filtros del sidebar aplicados como WHERE: el cliente recibe unos cuantos KB en
+-- lugar de la tabla completa. Se ejecuta con los permisos del invocador (aplica RLS).
+
+create or replace function public.resumen_fugas(
+    fluidos text[],
+    estados text[],
+    areas text[],
+    fecha text default null
+)
+returns table (
+    tipo_fuga text,
+    estado text,
+    area text,
+    severidad text,
+    categoria text,
+    n bigint,
+    costo double precision
+)
+language sql
+stable
+as $$
+    select f.tipo_fuga::text, f.estado::text, f.area::text, f.severidad::text, f.categoria::text,
+           count(*) as n,
+           coalesce(sum(f.costo_anual), 0)::double precision as costo
+    from public.fugas f
+    where f.tipo_fuga = any(fluidos)
+      and f.estado = any(estados)
+      and f.area = any(areas)
+      and (fecha is null or strpos(lower(f.zona), lower(fecha)) > 0)
+    group by f.tipo_fuga, f.estado, f.area, f.severidad, f.categoria;
+$$;
+
+grant execute on function public.resumen_fugas(text[], text[], text[], text) to anon, authenticated;
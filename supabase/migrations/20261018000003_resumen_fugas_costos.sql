@@ -0,0 +1,41 @@
+-- Costo de referencia en el resumen del Reporte
+-- La App completa el costo_anual vacío con el costo de RELACION_FUGAS por (fluido,
+-- categoría) antes de armar su cubo local. Para que la RPC y el respaldo local den los
+-- mismos totales, el servidor aplica el mismo relleno. La tabla de referencia viaja como
+-- parámetro (jsonb) desde la App, así no hay una segunda copia que pueda desfasarse.
+
+drop function if exists public.resumen_fugas(text[], text[], text[], text);
+
+create or replace function public.resumen_fugas(
+    fluidos text[],
+    estados text[],
+    areas text[],
+    fecha text default null,
+    costos jsonb default '[]'::jsonb
+)
+returns table (
+    tipo_fuga text,
+    estado text,
+    area text,
+    severidad text,
+    categoria text,
+    n bigint,
+    costo double precision
+)
+language sql
+stable
+as $$
+    select f.tipo_fuga::text, f.estado::text, f.area::text, f.severidad::text, f.categoria::text,
+           count(*) as n,
+           coalesce(sum(coalesce(f.costo_anual::double precision, r.costo)), 0)::double precision as costo
+    from public.fugas f
+    left join jsonb_to_recordset(costos) as r(tipo_fuga text, categoria text, costo double precision)
+        on r.tipo_fuga = f.tipo_fuga::text and r.categoria = f.categoria::text
+    where f.tipo_fuga = any(fluidos)
+      and f.estado = any(estados)
+      and f.area = any(areas)
+      and (fecha is null or strpos(lower(f.zona), lower(fecha)) > 0)
+    group by f.tipo_fuga, f.estado, f.area, f.severidad, f.categoria;
+$$;
+
+grant execute on function public.resumen_fugas(text[], text[], text[], text, jsonb) to anon, authenticated;
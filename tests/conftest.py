@@ -0,0 +1,46 @@
+import pathlib
+import re
+import sqlite3
+from contextlib import closing
+
+import pandas as pd
+
+SCRIPT = pathlib.Path(__file__).resolve().parents[1] / "StreamlitClickableImages.py"
+PATRON_SECCION = re.compile(r"^# --- (.+?) ---\s*$", re.MULTILINE)
+
+
+def secciones(*titulos, **globales):
+    # La App es un solo script de Streamlit: en lugar de importarlo (levantaría la UI)
+    # ejecutamos sus importaciones y solo las secciones "# --- TÍTULO ---" pedidas.
+    fuente = SCRIPT.read_text(encoding="utf-8")
+    marcas = list(PATRON_SECCION.finditer(fuente))
+    ns = {"__name__": "app_bajo_prueba"}
+    exec(compile(fuente[:marcas[0].start()], str(SCRIPT), "exec"), ns)
+    ns.update(globales)
+    for titulo in titulos:
+        i = next(i for i, m in enumerate(marcas) if m.group(1) == titulo)
+        fin = marcas[i + 1].start() if i + 1 < len(marcas) else len(fuente)
+        # Compilamos con el prefijo en blanco para que los tracebacks den la línea real
+        prefijo = "\n" * fuente.count("\n", 0, marcas[i].start())
+        exec(compile(prefijo + fuente[marcas[i].start():fin], str(SCRIPT), "exec"), ns)
+    return ns
+
+
+def fila_cruda(id_fuga, **valores):
+    # Fila tal como la devuelve Supabase (nombres en minúsculas)
+    fila = {
+        "id": id_fuga, "x1": 10.0, "y1": 10.0, "x2": 40.0, "y2": 40.0,
+        "zona": "01/03/2026 - 30/12/2026", "tipo_fuga": "Aire", "area": "Ensamble",
+        "ubicacion": "Terrestre", "id_maquina": f"M-{id_fuga}", "severidad": "Media",
+        "categoria": "Fuga A", "l_min": 5.05, "costo_anual": 60.0,
+        "estado": "Dañada", "comentarios": "", "updated_at": "2026-10-18T10:00:00+00:00",
+    }
+    fila.update(valores)
+    return fila
+
+
+def tabla_sqlite(ruta, filas, tabla="fugas"):
+    with closing(sqlite3.connect(ruta)) as con:
+        pd.DataFrame(filas).to_sql(tabla, con, index=False)
+        con.commit()
+    return str(ruta)
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+from conftest import secciones
+
+app = secciones("ÍNDICE DE BÚSQUEDA DEL HISTORIAL")
+
+
+def frame():
+    return pd.DataFrame({
+        "id": pd.array([1, 2, 12, 120, 7], dtype="Int64"),
+        "Zona": ["01/03/2026 - 30/09/2026"] * 5,
+        "ID_Maquina": ["M-10", "Compresor-3", "M-12", "Prensa 4", "M-7"],
+        "Area": ["Ensamble", "Pintura", "Soldadura", "Pintura", "Almacén"],
+        "Comentarios": pd.array(["Válvula dañada en línea principal", None, "fuga en conexión rápida",
+                                 "línea de aire secundaria", None], dtype="string"),
+    })
+
+
+def ids(df, posiciones):
+    return sorted(df["id"].iloc[posiciones].tolist())
+
+
+def test_prefijo_sin_acentos_ni_mayusculas():
+    df = frame()
+    indice = app["IndiceBusqueda"](df)
+    assert ids(df, indice.buscar("VALV")) == [1]
+    assert ids(df, indice.buscar("lin")) == [1, 120]
+    assert ids(df, indice.buscar("almacen")) == [7]
+    assert ids(df, indice.buscar("12")) == [12, 120]
+
+
+def test_varios_terminos_se_combinan_con_and():
+    df = frame()
+    indice = app["IndiceBusqueda"](df)
+    assert ids(df, indice.buscar("línea aire")) == [120]
+    assert ids(df, indice.buscar("pint compresor")) == [2]
+    assert len(indice.buscar("pintura soldadura")) == 0
+
+
+def test_consulta_sin_terminos():
+    indice = app["IndiceBusqueda"](frame())
+    assert indice.buscar("") is None
+    assert indice.buscar("  -- ") is None
+
+
+def test_comentarios_nulos_no_sacan_la_fila_del_indice():
+    df = frame()
+    indice = app["IndiceBusqueda"](df)
+    assert ids(df, indice.buscar("m")) == [1, 7, 12]
+    assert ids(df, indice.buscar("compresor")) == [2]
+
+
+def test_posiciones_con_huecos_en_el_index_tras_borrar():
+    # Tras borrar filas el index del frame queda con huecos (0, 2, 4...); el índice de
+    # búsqueda devuelve posiciones (iloc), que es lo que usa la máscara del historial
+    df = frame().drop(index=[1, 3])
+    assert df.index.tolist() == [0, 2, 4]
+    indice = app["IndiceBusqueda"](df)
+    posiciones = indice.buscar("m")
+    assert posiciones.max() < len(df)
+    mascara = np.zeros(len(df), dtype=bool)
+    mascara[posiciones] = True
+    assert sorted(df["id"][mascara].tolist()) == [1, 7, 12]
+    assert ids(df, indice.buscar("pintura")) == []
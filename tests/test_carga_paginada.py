@@ -0,0 +1,69 @@
+import sqlite3
+from contextlib import closing
+
+import pytest
+
+from conftest import fila_cruda, secciones, tabla_sqlite
+
+app = secciones("2. CONEXIÓN SUPABASE", "ESQUEMA TIPADO", "CARGA MASIVA PAGINADA")
+
+
+def cargar(ruta, **opciones):
+    obtener_pagina, rango_ids = app["fuente_sqlite"](ruta)
+    return app["cargar_fugas_paginado"](obtener_pagina, rango_ids, **opciones)
+
+
+@pytest.mark.parametrize("n, tam_pagina, hilos", [
+    (1, 10, 4),       # una sola fila
+    (10, 10, 1),      # exactamente una página
+    (11, 10, 1),      # una fila en la página siguiente
+    (40, 10, 4),      # múltiplo exacto del tamaño de página, en paralelo
+    (97, 10, 3),      # tramos de tamaño desigual
+])
+def test_limites_de_pagina(tmp_path, n, tam_pagina, hilos):
+    ruta = tabla_sqlite(tmp_path / "fugas.db", [fila_cruda(i) for i in range(1, n + 1)])
+    df = cargar(ruta, tam_pagina=tam_pagina, hilos=hilos)
+    assert df["id"].tolist() == list(range(1, n + 1))
+
+
+def test_ids_con_huecos_y_servidor_con_tope(tmp_path):
+    ids = [1, 2, 3, 500, 501, 9000, 9001, 9002, 20000]
+    ruta = tabla_sqlite(tmp_path / "fugas.db", [fila_cruda(i) for i in ids])
+    obtener_pagina, rango_ids = app["fuente_sqlite"](ruta)
+    # max-rows del servidor (2) menor que la página pedida: una página corta no es el final
+    con_tope = lambda despues_de, hasta, limite: obtener_pagina(despues_de, hasta, min(limite, 2))
+    df = app["cargar_fugas_paginado"](con_tope, rango_ids, tam_pagina=5, hilos=4)
+    assert df["id"].tolist() == ids
+
+
+def test_tabla_vacia_devuelve_frame_tipado(tmp_path):
+    ruta = str(tmp_path / "fugas.db")
+    with closing(sqlite3.connect(ruta)) as con:
+        con.execute("CREATE TABLE fugas (id INTEGER PRIMARY KEY, x1 REAL, tipo_fuga TEXT)")
+    df = cargar(ruta)
+    assert df.empty
+    for col, tipo in app["ESQUEMA_FUGAS"].items():
+        assert str(df[col].dtype) == tipo, col
+
+
+def test_tabla_de_100k_filas(tmp_path):
+    # Sustituto local de PostgREST con el tamaño de tabla que motivó la carga paginada
+    n = 100_000
+    ruta = str(tmp_path / "fugas.db")
+    base = fila_cruda(0)
+    columnas = list(base)
+    with closing(sqlite3.connect(ruta)) as con:
+        con.execute(f"CREATE TABLE fugas ({', '.join(columnas)})")
+        con.executemany(f"INSERT INTO fugas VALUES ({', '.join('?' * len(columnas))})",
+                        ([i] + [base[c] for c in columnas[1:]] for i in range(1, n + 1)))
+        con.commit()
+    obtener_pagina, rango_ids = app["fuente_sqlite"](ruta)
+    paginas = []
+    def contar(*argumentos):
+        paginas.append(argumentos)
+        return obtener_pagina(*argumentos)
+    df = app["cargar_fugas_paginado"](contar, rango_ids)
+    assert len(df) == n and df["id"].is_unique and df["id"].is_monotonic_increasing
+    # Tramos contiguos por hilo, sin páginas vacías ni repetidas: exactamente n / TAM_PAGINA
+    assert len(paginas) == n // app["TAM_PAGINA"]
+    assert len({(a, b) for a, b, _ in paginas}) == len(paginas)
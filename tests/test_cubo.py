@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+
+from conftest import secciones
+
+app = secciones("ESQUEMA TIPADO", "CUBO DE KPIs")
+
+
+def frame():
+    return pd.DataFrame({
+        "id": range(1, 7),
+        "TipoFuga": ["Aire", "Aire", "Agua", None, "Aire", "Agua"],
+        "Estado": ["Dañada", None, "Completada", "Dañada", None, "Dañada"],
+        "Area": ["Ensamble", "Pintura", "Pintura", None, "Ensamble", "Pintura"],
+        "Severidad": ["Alta", "Baja", None, "Media", "Alta", "Baja"],
+        "Categoria": ["Fuga A", "Fuga B", "Fuga A", "Fuga C", None, "Fuga B"],
+        "CostoAnual": [60.0, 300.0, np.nan, 680.0, 60.0, 300.0],
+    }).astype({c: "category" for c in app["COLUMNAS_CATEGORICAS"] if c != "Ubicacion"})
+
+
+def test_suma_por_conserva_los_nulos_de_las_dimensiones():
+    cubo = app["construir_cubo"](frame())
+    assert cubo["n"].sum() == 6
+    por_estado = app["suma_por"](cubo, ["Estado"])
+    assert por_estado["n"].sum() == 6
+    assert por_estado.loc[por_estado["Estado"].isna(), "n"].item() == 2
+    graficas = app["suma_por"](cubo, ["TipoFuga", "Estado", "Severidad", "Categoria"], ["n", "costo"])
+    assert graficas["n"].sum() == 6 and graficas["costo"].sum() == 1400.0
+
+
+def test_suma_por_puede_descartar_nulos():
+    cubo = app["construir_cubo"](frame())
+    por_categoria = app["suma_por"](cubo, ["Categoria"], dropna=True)
+    assert por_categoria["n"].sum() == 5
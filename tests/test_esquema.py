@@ -0,0 +1,30 @@
+import numpy as np
+
+from conftest import fila_cruda, secciones
+
+app = secciones("2. CONEXIÓN SUPABASE", "ESQUEMA TIPADO", "CARGA MASIVA PAGINADA", "SINCRONIZACIÓN INCREMENTAL (DELTA)")
+
+
+def test_normalizar_sin_filas_devuelve_frame_tipado():
+    df = app["normalizar_fugas"]([])
+    assert df.empty
+    for col, tipo in app["ESQUEMA_FUGAS"].items():
+        assert str(df[col].dtype) == tipo, col
+
+
+def test_caudal_y_costo_todos_nulos():
+    df = app["normalizar_fugas"]([fila_cruda(1, l_min=None, costo_anual=None),
+                                  fila_cruda(2, l_min=None, costo_anual=None)])
+    for col in ("L_min", "CostoAnual"):
+        assert df[col].dtype == np.float64 and df[col].isna().all()
+
+
+def test_rangos_viejos_de_caudal_al_punto_medio():
+    df = app["normalizar_fugas"]([fila_cruda(1, l_min="10.1-20 I/min"), fila_cruda(2, l_min="7")])
+    assert df["L_min"].tolist() == [15.05, 7.0]
+
+
+def test_borrado_local_sin_filas_nuevas():
+    df = app["normalizar_fugas"]([fila_cruda(i) for i in range(1, 6)])
+    restante = app["fusionar_delta"](df, [], {3})
+    assert restante["id"].tolist() == [1, 2, 4, 5]
@@ -0,0 +1,45 @@
+from functools import cache
+from types import SimpleNamespace
+
+import pandas as pd
+
+from conftest import secciones
+
+# La sección termina publicando el índice de la sesión; basta con un almacén de mentira
+st_falso = SimpleNamespace(cache_resource=cache, session_state=SimpleNamespace(dfZonas=None))
+almacen_falso = SimpleNamespace(derivado=lambda nombre, version, df, fn: None)
+app = secciones("ÍNDICE ESPACIAL (REJILLA UNIFORME SOBRE x1,y1,x2,y2)",
+                st=st_falso, almacen=almacen_falso, version_datos=0)
+
+
+def frame(cajas):
+    return pd.DataFrame([{"id": i, "x1": a, "y1": b, "x2": c, "y2": d} for i, (a, b, c, d) in cajas.items()])
+
+
+def test_consulta_con_bordes_incluidos():
+    indice = app["IndiceEspacial"](25).siguiente(1, frame({1: (0, 0, 10, 10), 2: (50, 50, 60, 60), 3: (10, 0, 20, 5)}))
+    assert indice.consultar((10, 10, 40, 40)) == [1]
+    assert indice.consultar((5, 0, 15, 2)) == [1, 3]
+    assert indice.consultar((100, 100, 200, 200)) == []
+
+
+def test_version_nueva_no_modifica_la_anterior():
+    v1 = app["IndiceEspacial"](25).siguiente(1, frame({1: (0, 0, 10, 10), 2: (50, 50, 60, 60)}))
+    v2 = v1.siguiente(2, frame({2: (0, 0, 5, 5), 3: (80, 80, 90, 90)}))
+    assert v1.version == 1 and v2.version == 2 and v2 is not v1
+    assert v1.consultar((0, 0, 10, 10)) == [1]
+    assert v1.consultar((80, 80, 90, 90)) == []
+    assert v2.consultar((0, 0, 10, 10)) == [2]
+    assert v2.consultar((50, 50, 60, 60)) == []
+    assert v2.siguiente(2, None) is v2
+
+
+def test_indice_de_version_publica_el_mas_reciente():
+    d1 = frame({1: (0, 0, 10, 10)})
+    i1 = app["indice_de_version"](1, d1)
+    i2 = app["indice_de_version"](2, frame({1: (0, 0, 10, 10), 2: (30, 30, 40, 40)}))
+    # Una sesión atrasada pide la versión 1 otra vez: obtiene un índice propio y no retrocede el publicado
+    i1_otra = app["indice_de_version"](1, d1)
+    assert i1_otra is not i2 and i1_otra.consultar((30, 30, 40, 40)) == []
+    assert app["indice_espacial"]()["ultimo"] is i2
+    assert i1.consultar((0, 0, 40, 40)) == [1]
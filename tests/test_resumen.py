@@ -0,0 +1,67 @@
+import functools
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+from conftest import fila_cruda, secciones, tabla_sqlite
+
+st = SimpleNamespace(cache_resource=functools.cache, session_state=SimpleNamespace(dfZonas=pd.DataFrame()),
+                     secrets={}, error=lambda *a, **k: None)
+app = secciones(
+    "2. CONEXIÓN SUPABASE", "ESQUEMA TIPADO", "Configuarcion de formulas de categorias por fluido",
+    "TABLA COMPILADA DE RELACION_FUGAS", "MÁSCARAS DE FILTRO POR VERSIÓN", "CUBO DE KPIs", "AGREGACIÓN EN EL SERVIDOR (REPORTE)",
+    st=st, version_datos=0,
+    almacen=SimpleNamespace(derivado=lambda nombre, version, df, fn, *claves: fn(df)),
+    cache_mapas=lambda: SimpleNamespace(obtener=lambda clave, construir: construir()[0]),
+)
+DIMENSIONES = list(app["COLUMNAS_RESUMEN"].values())
+
+
+def filas():
+    # Costos vacíos (se completan con TABLA_FUGAS), un fluido sin referencia y dimensiones nulas
+    return [
+        fila_cruda(1),
+        fila_cruda(2, costo_anual=None),
+        fila_cruda(3, tipo_fuga="Agua", categoria="Fuga B", costo_anual=None),
+        fila_cruda(4, tipo_fuga="Gas Natural", categoria="Fuga C", costo_anual=None, zona="05/09/2026"),
+        fila_cruda(5, severidad=None, categoria=None, costo_anual=None),
+        fila_cruda(6, tipo_fuga="Helio", estado="Completada", costo_anual=1234.5),
+        fila_cruda(7, tipo_fuga="Inspección (OK)", categoria="Fuga A", costo_anual=None, zona="05/09/2026"),
+        fila_cruda(8, costo_anual=None, zona="01/05/2026 - 30/09/2026"),
+    ]
+
+
+def normalizado(cubo):
+    cubo = cubo.astype({c: object for c in DIMENSIONES}).fillna({c: "" for c in DIMENSIONES})
+    return cubo.sort_values(DIMENSIONES).reset_index(drop=True)[DIMENSIONES + ["n", "costo"]]
+
+
+# "01.05" como regex coincidiría con "01/05": la búsqueda es literal en ambos caminos
+@pytest.mark.parametrize("fecha", [None, "05/09", "01/05", "01.05"])
+def test_resumen_sqlite_coincide_con_el_cubo_local(tmp_path, fecha):
+    ruta = tabla_sqlite(tmp_path / "fugas.db", filas())
+    df = app["completar_caudal_costo"](app["normalizar_fugas"](filas()))
+    st.session_state.dfZonas = df
+    fluidos = ["Aire", "Agua", "Gas Natural", "Helio", "Inspección (OK)"]
+    estados, areas = ["Dañada", "Completada"], ["Ensamble"]
+    # Mismo camino que la App: máscaras del sidebar y luego la búsqueda de fecha
+    mascara = app["FiltrosDataset"](df).mascara(TipoFuga=fluidos, Estado=estados, Area=areas)
+    df = app["filtrar_por_fecha"](df[mascara], fecha)
+
+    remoto = app["cubo_desde_resumen"](app["resumen_sqlite"](ruta)(fluidos, estados, areas, fecha))
+    local = app["cubo_kpi"](df, (0, fluidos, estados, areas, fecha))
+
+    pd.testing.assert_frame_equal(normalizado(remoto), normalizado(local), check_dtype=False)
+    assert remoto["n"].sum() == len(df) == {None: 8, "05/09": 2, "01/05": 1, "01.05": 0}[fecha]
+
+
+def test_resumen_sqlite_completa_el_costo_vacio(tmp_path):
+    ruta = tabla_sqlite(tmp_path / "fugas.db", filas())
+    fluidos = ["Aire", "Agua", "Gas Natural"]
+    cubo = app["cubo_desde_resumen"](app["resumen_sqlite"](ruta)(fluidos, ["Dañada"], ["Ensamble"], None))
+    costos = cubo.groupby("TipoFuga")["costo"].sum()
+    # Aire: 60 capturado + 2 x 60 de referencia (Fuga A); la fila sin categoría y Agua (sin referencia) quedan en 0
+    assert costos["Aire"] == 180.0
+    assert costos["Gas Natural"] == app["TABLA_FUGAS"].loc[("Gas Natural", "Fuga C"), "costo"]
+    assert costos["Agua"] == 0.0
@@ -0,0 +1,103 @@
+import threading
+
+import pandas as pd
+
+from conftest import fila_cruda, secciones, tabla_sqlite
+
+app = secciones("2. CONEXIÓN SUPABASE", "ESQUEMA TIPADO", "CARGA MASIVA PAGINADA", "SINCRONIZACIÓN INCREMENTAL (DELTA)")
+
+
+def test_marca_con_fracciones_de_segundo_mezcladas():
+    df = pd.DataFrame({
+        "id": [1, 2, 3],
+        "updated_at": ["2026-10-18T10:00:00+00:00",
+                       "2026-10-18T10:00:07+00:00",
+                       "2026-10-18T10:00:09.250+00:00"],
+    })
+    marca = app["calcular_marca"](df)
+    assert marca["updated_at"] == "2026-10-18T10:00:09.250000+00:00"
+    assert marca["id"] == 3
+
+
+def test_delta_paginado_no_se_corta_en_max_rows(tmp_path):
+    ruta = tabla_sqlite(tmp_path / "fugas.db", [fila_cruda(i) for i in range(1, 26)])
+    obtener_pagina, _ = app["fuente_sqlite"](ruta)
+    # Servidor con max-rows (7) menor que la página pedida
+    con_tope = lambda despues_de, hasta, limite: obtener_pagina(despues_de, hasta, min(limite, 7))
+    filas = app["filas_paginadas"](con_tope, tam_pagina=10)
+    assert [f["id"] for f in filas] == list(range(1, 26))
+    assert [f["id"] for f in app["filas_paginadas"](con_tope, 20)] == list(range(21, 26))
+
+
+def almacen_con_delta(filas_delta):
+    ns = secciones("2. CONEXIÓN SUPABASE", "ESQUEMA TIPADO", "CARGA MASIVA PAGINADA",
+                   "SINCRONIZACIÓN INCREMENTAL (DELTA)", "CACHÉ COMPARTIDA DEL DATASET (TODAS LAS SESIONES)")
+    ns["supabase"] = object()
+    ns["obtener_delta"] = lambda marca, ids_cambiados=None: (list(filas_delta), set(), marca["borrado_at"])
+    almacen = ns["AlmacenFugas"](60)
+    df = ns["normalizar_fugas"]([fila_cruda(1), fila_cruda(2, updated_at="2026-10-18T10:00:05.5+00:00")])
+    almacen.publicar(df, ns["calcular_marca"](df))
+    return ns, almacen
+
+
+def test_sincronizacion_ociosa_no_publica_version():
+    # gte repite la fila de la marca: con el mismo updated_at no es un cambio
+    frontera = fila_cruda(2, updated_at="2026-10-18T10:00:05.500+00:00")
+    ns, almacen = almacen_con_delta([frontera])
+    for _ in range(3):
+        ns["sincronizar_datos"](almacen)
+    assert almacen.version == 1
+
+
+def test_sincronizacion_publica_la_fila_de_la_frontera_si_cambio():
+    editada = fila_cruda(2, estado="Completada", updated_at="2026-10-18T10:00:06+00:00")
+    ns, almacen = almacen_con_delta([editada])
+    ns["sincronizar_datos"](almacen)
+    assert almacen.version == 2
+    assert almacen.df.set_index("id").loc[2, "Estado"] == "Completada"
+
+
+def test_sesiones_concurrentes_comparten_una_sincronizacion():
+    llamadas = []
+    ns, almacen = almacen_con_delta([fila_cruda(3, updated_at="2026-10-18T10:01:00+00:00")])
+    delta = ns["obtener_delta"]
+    ns["obtener_delta"] = lambda *a, **k: llamadas.append(1) or delta(*a, **k)
+    almacen.sincronizado_en = 0.0  # TTL vencido
+
+    def sesion():
+        if almacen.vencido():
+            ns["sincronizar_datos"](almacen, si_vencido=True)
+    hilos = [threading.Thread(target=sesion) for _ in range(8)]
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+    assert len(llamadas) == 1
+    assert almacen.version == 2
+
+
+def test_recarga_fallida_conserva_frame_y_version():
+    ns, almacen = almacen_con_delta([])
+    ns["cargar_datos"] = lambda: None
+    version, df = almacen.leer()
+    ns["sincronizar_datos"](almacen, forzar=True, reiniciar=True)
+    assert almacen.leer() == (version, df)
+    assert list(almacen.df["id"]) == [1, 2]
+
+
+def test_recarga_reinicia_en_la_misma_seccion_critica():
+    ns, almacen = almacen_con_delta([])
+    almacen.derivados[("indice", 1)] = object()
+    lecturas, hilos = [], []
+    # Otra sesión que lee mientras la carga completa está en curso: espera al candado
+    def cargar():
+        hilos.append(threading.Thread(target=lambda: lecturas.append(almacen.leer())))
+        hilos[0].start()
+        hilos[0].join(0.2)
+        return ns["normalizar_fugas"]([fila_cruda(7)])
+    ns["cargar_datos"] = cargar
+    ns["sincronizar_datos"](almacen, forzar=True, reiniciar=True)
+    hilos[0].join()
+    assert almacen.version == 2 and list(almacen.df["id"]) == [7]
+    assert almacen.derivados == {}
+    assert [v for v, df in lecturas if df is not None] == [2]